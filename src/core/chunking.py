@@ -2,12 +2,13 @@ import json
 import os
 import re
 import time
+from bisect import bisect_left
 from typing import Literal
 from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
 from langchain_experimental.text_splitter import SemanticChunker
 from langchain_nomic import NomicEmbeddings
 
-from thefuzz import fuzz
+from rapidfuzz.fuzz import partial_ratio_alignment
 from core.model import generate_response
 from core.utils import merge_document
 from domain.document import Document, Chunk, ChunkType
@@ -271,68 +272,113 @@ def chunk_by_section_and_size(
     return chunks
 
 
+class PageAligner:
+    """
+    Locates chunks in the concatenated content of the pages they were cut from and maps them to page spans.
+
+    The pages are joined once into a PageBuffer with "\\f" like merge_document. A chunk is looked up from the
+    position of the previous chunk by exact search, then by exact search with collapsed whitespace and finally by
+    fuzzy alignment within a window of a few chunk lengths. The pages of the match are found by binary search over
+    the page offsets of the buffer.
+    """
+
+    SEPARATOR = "\f"
+
+    def __init__(self, document: Document, pages: list[int], similarity_threshold: int):
+        self.buffer = document.to_page_buffer(pages, self.SEPARATOR)
+        self.similarity_threshold = similarity_threshold
+        self.text = self.buffer.text
+        self._normalized_text = None
+        self._normalized_offsets = None
+
+    def page_span(self, start: int, end: int) -> tuple[int, int]:
+        """Page numbers of the first and the last character of text[start:end]."""
+        return self.buffer.page_at(start), self.buffer.page_at(max(start, end - 1))
+
+    def locate(self, chunk_text: str, cursor: int = 0) -> tuple[int, int] | None:
+        """Returns the (start, end) offsets of chunk_text in the pages at or after cursor, None if not found."""
+        chunk_text = chunk_text.strip()
+        if not chunk_text:
+            return None
+
+        start = self.text.find(chunk_text, cursor)
+        if start != -1:
+            return start, start + len(chunk_text)
+
+        if (span := self._locate_normalized(chunk_text, cursor)) is not None:
+            return span
+
+        return self._locate_fuzzy(chunk_text, cursor)
+
+    def _normalize(self):
+        # Every run of whitespace (page separators included) becomes one space, offsets map back to self.text
+        pieces, offsets = [], []
+        for match in re.finditer(r"\s+|\S+", self.text):
+            if match.group()[0].isspace():
+                pieces.append(" ")
+                offsets.append(match.start())
+            else:
+                pieces.append(match.group())
+                offsets.extend(range(match.start(), match.end()))
+        self._normalized_text = "".join(pieces)
+        self._normalized_offsets = offsets
+
+    def _locate_normalized(self, chunk_text: str, cursor: int) -> tuple[int, int] | None:
+        if self._normalized_text is None:
+            self._normalize()
+        normalized_chunk = " ".join(chunk_text.split())
+        normalized_cursor = bisect_left(self._normalized_offsets, cursor)
+        start = self._normalized_text.find(normalized_chunk, normalized_cursor)
+        if start == -1:
+            return None
+        end = start + len(normalized_chunk) - 1
+        return self._normalized_offsets[start], self._normalized_offsets[end] + 1
+
+    def _locate_fuzzy(self, chunk_text: str, cursor: int) -> tuple[int, int] | None:
+        window_end = cursor + 3 * len(chunk_text) + 1000
+        alignment = partial_ratio_alignment(
+            chunk_text, self.text[cursor:window_end], score_cutoff=self.similarity_threshold
+        )
+        if alignment is None:
+            return None
+        return cursor + alignment.dest_start, cursor + alignment.dest_end
+
+
 def match_chunks_with_pages(
     chunks: list[Chunk],
     document: Document,
     pages: list[int],
     similarity_threshold: int = config.match_chunk_similarity_threshold,
-    overlap: bool = False,
 ):
     """
+    Sets start_page and end_page of chunks that were cut in order from the given pages.
+
     Args:
-        chunks (list[Chunk]): _description_
-        document (Document): _description_
-        start_page (int): _description_
-        overlap (bool, optional): _description_. Defaults to False.
+        chunks (list[Chunk]): Chunks in document order, overlapping chunks are fine.
+        document (Document): Document the chunks were cut from.
+        pages (list[int]): Page numbers the chunks were cut from, in document order.
+        similarity_threshold (int, optional): Minimum partial ratio of a fuzzy match. Defaults to config.
+
+    Returns:
+        tuple[list[Chunk], int]: The chunks and the number of chunks that could not be located.
     """
+    start = time.time()
+    aligner = PageAligner(document, pages, similarity_threshold)
     problem_counter = 0
+    cursor = 0
 
-    start_pointer = 0  # index
-    current_pointer = start_pointer
-
-    for n, chunk in enumerate(chunks):
-        matched = False
-        start = time.time()
-
-        while not matched:
-            interest_part = " ".join(
-                document.get_page(pages[i]).processed_content for i in range(start_pointer, current_pointer + 1)
-            )
-
-            if len(interest_part) < len(chunk.text):
-                current_pointer += 1
-                continue
-
-            rat = fuzz.partial_ratio(chunk.text, interest_part)
-
-            if rat > similarity_threshold:
-                matched = True
-                chunk.start_page = pages[start_pointer]
-                chunk.end_page = pages[current_pointer]
-
-                trailing_part = document.get_page(pages[current_pointer]).processed_content[-300:]
-                if overlap and fuzz.partial_ratio(trailing_part, chunk.text) > similarity_threshold:
-                    start_pointer = current_pointer + 1
-                else:
-                    start_pointer = current_pointer
-            else:
-                current_pointer += 1
-
-            if current_pointer >= len(pages):
-                print("Chunk not found in document")
-                problem_counter += 1
-                break
-
-            if current_pointer - start_pointer == 15:
-                print("Pointers grew apart")
-                print("Chunk: ", chunk.text)
-                problem_counter += 1
-                break
-
-            if time.time() - start > 120:
-                print("Timeout")
-                problem_counter += 1
-                break
+    for chunk in chunks:
+        span = aligner.locate(chunk.text, cursor)
+        if span is None:
+            print("Chunk not found in document")
+            print("Chunk: ", chunk.text)
+            problem_counter += 1
+            continue
+        chunk.start_page, chunk.end_page = aligner.page_span(*span)
+        # The next chunk starts after this one starts, it may overlap this one
+        cursor = span[0] + 1
+
+    print(f"Matched {len(chunks)} chunks with pages in {time.time() - start:.2f}s")
     print(f"Problems encountered while matching chunks with pages: {problem_counter}")
     return chunks, problem_counter
 
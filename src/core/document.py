@@ -1,5 +1,13 @@
 from pypdf import PdfReader
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, TypeVar
+import hashlib
+import math
 import re
+import sqlite3
+import threading
 import time
 import os
 import json
@@ -8,7 +16,9 @@ from domain.document import Document, Page
 from core.utils import levenshteinDistance, normalize_text, replace_abbreviations
 from core.model import generate_response
 from parsing import get_format_instructions, WhitespaceInjectionResponse, parse_with_retry
-from settings import settings, get_page_types
+from settings import settings, config, get_page_types
+
+T = TypeVar("T")
 
 header_pattern = r"Klinik\sund\sPoliklinik\sfür\sNeurologie"
 footer_pattern_page = r"Seite\s\d+\svon\s\d+"
@@ -30,44 +40,187 @@ REMOVE_LIST = [
     page_pattern,
 ]
 
+# All patterns in one alternation, so a page is scanned once
+BOILERPLATE_PATTERN = re.compile("|".join(f"(?:{pattern})" for pattern in REMOVE_LIST))
+
+
+def _generalize_line(line: str) -> str:
+    # Numbers match any number and whitespace any whitespace, so "Seite 3 von 90" also matches "Seite 4  von 90"
+    parts = re.split(r"([0-9]+|\s+)", line)
+    return "".join(
+        r"\d+" if part[0].isascii() and part[0].isdigit() else r"\s+" if part[0].isspace() else re.escape(part)
+        for part in parts
+        if part
+    )
+
+
+class BoilerplateStripper:
+    """
+    Removes boilerplate from page contents in a single pass.
 
-def calculate_num_changes(original, modified):
+    The REMOVE_LIST patterns are removed anywhere on a page. Header and footer lines detected with from_pages are
+    removed only among the first and last edge_lines lines of a page, so body text that looks the same stays.
+    """
+
+    def __init__(self, repeated_lines: list[str] | None = None, edge_lines: int = 3):
+        self.repeated_lines = repeated_lines or []
+        self.edge_lines = edge_lines
+        self._edge_pattern = re.compile("|".join(self.repeated_lines)) if self.repeated_lines else None
+
+    @classmethod
+    def from_pages(cls, contents: list[str], edge_lines: int = 3, min_fraction: float = 0.5) -> "BoilerplateStripper":
+        """
+        Detects header and footer lines that repeat across pages, so new documents need no hand-written patterns.
+
+        A line is boilerplate if it is among the first or last edge_lines non-empty lines of at least min_fraction
+        of the pages (and at least 3 pages), compared with numbers generalized so page numbers still match.
+        """
+        counts = Counter()
+        for content in contents:
+            lines = [line.strip() for line in content.splitlines() if line.strip()]
+            if len(lines) <= 2 * edge_lines:
+                # On a short page the edges are the whole page, that says nothing about headers
+                continue
+            counts.update({_generalize_line(line) for line in lines[:edge_lines] + lines[-edge_lines:]})
+        min_pages = max(3, math.ceil(min_fraction * len(contents)))
+        repeated_lines = [line for line, count in counts.items() if count >= min_pages]
+        print(f"Detected {len(repeated_lines)} repeated header and footer lines")
+        return cls(repeated_lines, edge_lines)
+
+    def __call__(self, content: str) -> str:
+        if self._edge_pattern is not None:
+            lines = content.split("\n")
+            non_empty = [i for i, line in enumerate(lines) if line.strip()]
+            for i in non_empty[: self.edge_lines] + non_empty[-self.edge_lines :]:
+                if self._edge_pattern.fullmatch(lines[i].strip()):
+                    lines[i] = ""
+            content = "\n".join(lines)
+        return BOILERPLATE_PATTERN.sub(" ", content)
+
+
+def calculate_num_changes(original, modified, max_changes: int | None = None):
+    """Number of changes apart from whitespace and punctuation, max_changes + 1 for anything above max_changes."""
     normalized_original = normalize_text(original)
     normalized_modified = normalize_text(modified)
 
-    distance = levenshteinDistance(normalized_original, normalized_modified)
+    distance = levenshteinDistance(normalized_original, normalized_modified, max_changes)
 
     return distance
 
 
-def inject_whitespace_w_llm(text: str) -> str:
-    system_prompt = """
+WHITESPACE_INJECTION_SYSTEM_PROMPT = """
         You're a helpful AI assistant that has been asked to fix a block of text where some words are concatenated due to errors in PDF extraction. Your task is to identify where spaces are missing between words and add them where necessary. Please only adjust spacing—do not modify punctuation, capitalization, or any part of the text otherwise. Also there is one exception, do not modify headings and subheadings. Return the modified text with spaces added where needed in a json format as follows: {"processed_text": "whitespace injected text here"}. Say nothing else and don't change anything else.
     """
-    user_prompt = """
+WHITESPACE_INJECTION_USER_PROMPT = """
      Text: {text}
     """
-    user_prompt = user_prompt.format(text=text)
-    response = generate_response(user_prompt, system_prompt, max_new_tokens=2048)
+
+
+def inject_whitespace_w_llm(text: str) -> str:
+    user_prompt = WHITESPACE_INJECTION_USER_PROMPT.format(text=text)
+    response = generate_response(
+        user_prompt, WHITESPACE_INJECTION_SYSTEM_PROMPT, max_new_tokens=2048, response_model=WhitespaceInjectionResponse
+    )
     parsed_response = parse_with_retry(WhitespaceInjectionResponse, response)
     return parsed_response.processed_text
 
 
-def inject_whitespace(content: str, num_changes_threshold: int = 50) -> str:
+class PageCache:
+    """Persistent results of the LLM preprocessing of pages keyed by a hash of the page content, backed by SQLite.
+
+    The key covers the content the stage received, so pages of a new handbook version that did not change are
+    served from the cache and only changed pages reach the LLM. The namespace identifies the model and prompt of
+    the stage, so a new model or prompt does not reuse results of the old one.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(stage: str, content: str, namespace: str = "") -> str:
+        return hashlib.sha256(f"{namespace}\0{stage}\0{content}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute("SELECT content FROM pages WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, content: str):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (key, content, time.time()))
+            self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM pages").fetchone()
+        return count
+
+
+_page_cache: PageCache | None = None
+_page_cache_lock = threading.Lock()
+
+
+def get_page_cache() -> PageCache | None:
+    """Returns the process-wide page cache, or None if config.page_cache_path is not set."""
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None and config.page_cache_path:
+            _page_cache = PageCache(config.page_cache_path)
+    return _page_cache
+
+
+def _whitespace_injection_namespace() -> str:
+    """Identifies the model and prompt of inject_whitespace_w_llm."""
+    prompt = f"{WHITESPACE_INJECTION_SYSTEM_PROMPT}\0{WHITESPACE_INJECTION_USER_PROMPT}"
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+    # llm_cache_namespace is changed when the served model changes without a config change
+    return f"{config.inference_type}:{config.llm_cache_namespace}:{config.constrained_decoding}:{prompt_hash}"
+
+
+def inject_whitespace(content: str, num_changes_threshold: int = 50, use_cache: bool = True) -> str:
+    if not content.strip():
+        return content
+
+    cache = get_page_cache() if use_cache else None
+    if cache is not None:
+        key = cache.make_key("whitespace_injection", content, _whitespace_injection_namespace())
+        if (cached := cache.get(key)) is not None:
+            return cached
+
     injected_content = inject_whitespace_w_llm(content)
-    num_changes = calculate_num_changes(content, injected_content)
-    print(f"Number of changes: {num_changes}")
+    num_changes = calculate_num_changes(content, injected_content, num_changes_threshold)
     if num_changes > num_changes_threshold:
-        print(f"Significant changes detected. Number of changes: {num_changes}")
+        print(f"Significant changes detected. Number of changes: more than {num_changes_threshold}")
         print("Original content: ", content)
         print("Modified content: ", injected_content)
+    else:
+        print(f"Number of changes: {num_changes}")
 
+    if cache is not None:
+        cache.put(key, injected_content)
     return injected_content
 
 
+def remove_patterns(content: str) -> str:
+    return BOILERPLATE_PATTERN.sub(" ", content)
+
+
 def preprocess_content(content: str, whitespace_injection: bool = False, is_replace_abbreviations: bool = False) -> str:
-    for pattern in REMOVE_LIST:
-        content = re.sub(pattern, " ", content)
+    content = remove_patterns(content)
 
     if whitespace_injection:
         content = inject_whitespace(content)
@@ -78,13 +231,13 @@ def preprocess_content(content: str, whitespace_injection: bool = False, is_repl
         return content, 0
 
 
-def remove_string(content: str, string: str, case_sensitive=True) -> str:
-    pattern = re.sub(r" ", r"\\s+", string)
+@lru_cache(maxsize=256)
+def _compile_removal_pattern(string: str, case_sensitive: bool) -> re.Pattern:
+    return re.compile(re.sub(r" ", r"\\s+", string), 0 if case_sensitive else re.IGNORECASE)
 
-    if not case_sensitive:
-        return re.sub(pattern, " ", content, flags=re.IGNORECASE)
 
-    return re.sub(pattern, " ", content)
+def remove_string(content: str, string: str, case_sensitive=True) -> str:
+    return _compile_removal_pattern(string, case_sensitive).sub(" ", content)
 
 
 def filter_document(document: Document, pages: list[int]) -> Document:
@@ -127,22 +280,50 @@ def load_document(file_path: str, pages: list[int] = []) -> Document:
     return doc
 
 
+def _map_pages(function: Callable[[str], T], contents: list[str]) -> list[T]:
+    """Applies a CPU-bound stage to all pages, in a process pool if config.preprocess_cpu_workers > 1."""
+    workers = config.preprocess_cpu_workers
+    if workers <= 1 or len(contents) <= 1:
+        return [function(content) for content in contents]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, contents, chunksize=max(1, len(contents) // (4 * workers))))
+
+
 def process_document(
     document: Document, whitespace_injection: bool = False, is_replace_abbreviations: bool = True
 ) -> Document:
+    """
+    Runs preprocess_content on all pages as a pipeline of stages over the whole document.
+
+    Boilerplate is stripped in one pass per page, with repeated headers and footers detected across the document
+    if config.detect_boilerplate is set. The regex stages run in a process pool if configured. Whitespace
+    injection, which makes one LLM call per page, runs config.preprocess_llm_workers pages at a time and skips
+    pages found in the page cache.
+    """
+    start = time.time()
+    contents = [page.processed_content for page in document.pages]
+    stripper = BoilerplateStripper.from_pages(contents) if config.detect_boilerplate else BoilerplateStripper()
+    contents = _map_pages(stripper, contents)
+
+    if whitespace_injection:
+        with ThreadPoolExecutor(max_workers=config.preprocess_llm_workers, thread_name_prefix="preprocess") as executor:
+            contents = list(executor.map(inject_whitespace, contents))
+
     total_replaced_abbrev_count = 0
-    for page in document.pages:
-        processed_content, replaced_count = preprocess_content(
-            page.processed_content, whitespace_injection, is_replace_abbreviations
-        )
-        page.processed_content = processed_content
-        total_replaced_abbrev_count += replaced_count
+    if is_replace_abbreviations:
+        replaced = _map_pages(replace_abbreviations, contents)
+        contents = [content for content, _ in replaced]
+        total_replaced_abbrev_count = sum(count for _, count in replaced)
+
+    for page, content in zip(document.pages, contents):
+        page.processed_content = content
 
     if whitespace_injection:
         document.save(
             document.path.replace(".pdf", f"_processed_with_whitespace_{int(time.time())}.pkl")
         )  # TODO: artifacts folder
     print(f"Number of abbreviations replaced total: {total_replaced_abbrev_count}")
+    print(f"Preprocessed {len(contents)} pages in {time.time() - start:.1f}s")
     return document
 
 
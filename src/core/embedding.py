@@ -1,15 +1,165 @@
 from nomic import embed
 from typing import Literal
+import hashlib
+import os
+import sqlite3
+import threading
+import time
 import numpy as np
 
+from settings.settings import config
+
+EMBEDDING_MODEL = "nomic-embed-text-v1.5"
+EMBEDDING_DIMENSION = 768
+
+
+class EmbeddingCache:
+    """Persistent embedding store keyed by (model, task_type, text hash), backed by SQLite with LRU eviction.
+
+    Lookups only read the database. The last use of the keys they found is collected in memory and written in one
+    transaction every TOUCH_INTERVAL seconds, or before an eviction so it still sees the recent reads.
+    """
+
+    # SQLite limits the number of host parameters per statement
+    _BATCH_SIZE = 500
+    TOUCH_INTERVAL = 60.0
+
+    def __init__(self, path: str, max_entries: int = 200_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> last use not yet written to the database
+        self._touched: dict[str, float] = {}
+        self._last_flush = time.time()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                task_type TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(model: str, task_type: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{task_type}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), self._BATCH_SIZE):
+                batch = keys[i : i + self._BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                    self._touched[key] = now
+            if now - self._last_flush > self.TOUCH_INTERVAL:
+                self._flush_touched()
+                self._connection.commit()
+        return found
+
+    def _flush_touched(self):
+        if self._touched:
+            self._connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self._touched.items()],
+            )
+            self._touched.clear()
+        self._last_flush = time.time()
+
+    def put_many(self, embeddings: dict[str, np.ndarray], model: str, task_type: str):
+        now = time.time()
+        rows = [
+            (key, model, str(task_type), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in embeddings.items()
+        ]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            for key in embeddings:
+                self._touched.pop(key, None)
+            self._flush_touched()
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+
+_embedding_cache: EmbeddingCache | None = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache | None:
+    """Returns the process-wide embedding cache, or None if config.embedding_cache_path is not set."""
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None and config.embedding_cache_path:
+            _embedding_cache = EmbeddingCache(config.embedding_cache_path, config.embedding_cache_max_entries)
+    return _embedding_cache
+
+
+# The local nomic model is a single in-process instance that is not safe to call from several threads
+_local_embed_lock = threading.Lock()
+
+
+def _embed(chunks: list[str], task_type, model: str, inference_mode: str) -> np.ndarray:
+    if inference_mode == "local":
+        with _local_embed_lock:
+            embed_res = embed.text(texts=chunks, model=model, task_type=task_type, inference_mode=inference_mode)
+    else:
+        embed_res = embed.text(texts=chunks, model=model, task_type=task_type, inference_mode=inference_mode)
+    return np.array(embed_res["embeddings"], dtype=np.float32)
+
 
 def embed_chunks(
     chunks: list[str] | str,
     task_type=Literal["search_document", "search_query"],
-    model="nomic-embed-text-v1.5",
+    model=EMBEDDING_MODEL,
     inference_mode="local",
+    use_cache: bool = True,
 ) -> np.ndarray:
     if isinstance(chunks, str):
         chunks = [chunks]
-    embed_res = embed.text(texts=chunks, model=model, task_type=task_type, inference_mode=inference_mode)
-    return np.array(embed_res["embeddings"])
+    if not chunks:
+        return np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+
+    cache = get_embedding_cache() if use_cache else None
+    if cache is None:
+        return _embed(chunks, task_type, model, inference_mode)
+
+    keys = [cache.make_key(model, task_type, chunk) for chunk in chunks]
+    embeddings = cache.get_many(keys)
+
+    # Embed each missing text once, even if it occurs several times in chunks
+    missing = {key: chunk for key, chunk in zip(keys, chunks) if key not in embeddings}
+    if missing:
+        print(f"Embedding cache: {len(missing)} of {len(set(keys))} unique texts not cached")
+        new_embeddings = _embed(list(missing.values()), task_type, model, inference_mode)
+        new_embeddings = dict(zip(missing.keys(), new_embeddings))
+        cache.put_many(new_embeddings, model, task_type)
+        embeddings.update(new_embeddings)
+
+    return np.stack([embeddings[key] for key in keys])
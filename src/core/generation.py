@@ -24,6 +24,15 @@ from parsing import (
 )
 
 
+def get_answer_model() -> type[Answer] | type[ReasoningAnswer] | type[ThinkingAnswer]:
+    if config.reasoning:
+        return ReasoningAnswer
+    elif config.thinking:
+        return ThinkingAnswer
+    else:
+        return Answer
+
+
 def summarize_documents(retrieved_documents: list[Chunk]) -> str:
     system_prompt = """
         Consider 5 given texts and write a concise summary. Texts might start or end with an incomplete sentence, do no try to complete them.  Do not deviate from the specified format and respond strictly in the following JSON format:
@@ -52,7 +61,7 @@ def summarize_documents(retrieved_documents: list[Chunk]) -> str:
     """
 
     user_prompt = "\n".join(f"Text {i + 1}:\n{doc.text}" for i, doc in enumerate(retrieved_documents))
-    response = generate_response(user_prompt, system_prompt)
+    response = generate_response(user_prompt, system_prompt, response_model=Summary)
     try:
         response = parse_with_retry(Summary, response)
         print("Response within summarization: ", response)
@@ -177,7 +186,7 @@ def describe_table_for_generation(table: Chunk, document: Document):
         
         The table content:\n{table.text}
         """  ## start and end page are the same for tables
-    response = generate_response(user_prompt, TABLES_DESCRIPTION_GENERATION_PROMPT)
+    response = generate_response(user_prompt, TABLES_DESCRIPTION_GENERATION_PROMPT, response_model=TableDescription)
     try:
         response = parse_with_retry(TableDescription, response)
         print("Response within summarization: ", response)
@@ -191,7 +200,7 @@ def markdown_table_for_generation(table: Chunk, document: Document):
     user_prompt = f"""
         The table content:\n{table.text}
         """  ## start and end page are the same for tables
-    response = generate_response(user_prompt, TABLES_MARKDOWN_GENERATION_PROMPT)
+    response = generate_response(user_prompt, TABLES_MARKDOWN_GENERATION_PROMPT, response_model=TableMarkdown)
     try:
         response = parse_with_retry(TableMarkdown, response)
         print("Response within summarization: ", response)
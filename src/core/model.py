@@ -1,6 +1,16 @@
-import requests
+import asyncio
+import hashlib
 import json
+import os
+import queue
 import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterator
+
+import httpx
+from pydantic import BaseModel
 
 from settings.settings import config
 from settings import LLM
@@ -57,35 +67,293 @@ def format_prompt(prompt_format: PromptFormat_llama3, user_prompt, system_prompt
 prompt_format = PromptFormat_llama3()
 
 
-def generate_response(user_prompt: str, system_prompt: str = None, max_new_tokens: int = config.max_new_tokens) -> str:
+_STREAM_END = object()
+
+
+class LLMClient:
+    """Pooled keep-alive HTTP client for the LLM/VLM servers with timeouts and retry/backoff.
+
+    All requests run on one background event loop that owns a single httpx.AsyncClient, so the blocking API shares
+    one connection pool whichever thread it is called from.
+    """
+
+    def __init__(
+        self,
+        timeout: float | None = None,
+        connect_timeout: float = 10.0,
+        max_connections: int = 32,
+        max_retries: int = 2,
+        retry_backoff: float = 1.0,
+    ):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._client: httpx.AsyncClient | None = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True)
+        self._thread.start()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def _retry_or_raise(self, url: str, error: Exception, attempt: int):
+        # Client errors will not succeed on a retry
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code < 500:
+            raise error
+        if attempt == self.max_retries:
+            raise error
+        delay = self.retry_backoff * 2**attempt
+        print(f"Request to {url} failed ({error!r}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def _post(self, url: str, data: dict) -> str:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._get_client().post(url, json=data)
+                response.raise_for_status()
+                return response.text
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                await self._retry_or_raise(url, e, attempt)
+
+    async def _stream(self, url: str, data: dict, emit: Callable[[str | Exception | object], None]):
+        """Reads a newline-delimited JSON stream of {"text": ...} pieces and passes each piece to `emit`.
+
+        Only failures before the first piece are retried, afterwards the partial output would be repeated.
+        Errors are passed to `emit` as well, followed by _STREAM_END in every case.
+        """
+        try:
+            for attempt in range(self.max_retries + 1):
+                received = False
+                try:
+                    async with self._get_client().stream("POST", url, json=data) as response:
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if line:
+                                received = True
+                                emit(json.loads(line)["text"])
+                    break
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    if received:
+                        raise
+                    await self._retry_or_raise(url, e, attempt)
+        except Exception as e:
+            emit(e)
+        finally:
+            emit(_STREAM_END)
+
+    def post(self, url: str, data: dict) -> str:
+        return asyncio.run_coroutine_threadsafe(self._post(url, data), self._loop).result()
+
+    def post_many(self, url: str, data_list: list[dict]) -> list[str]:
+        """Sends all requests concurrently so a batching server can group them, results keep the input order."""
+
+        async def gather():
+            return await asyncio.gather(*(self._post(url, data) for data in data_list))
+
+        return asyncio.run_coroutine_threadsafe(gather(), self._loop).result()
+
+    def stream(self, url: str, data: dict) -> Iterator[str]:
+        pieces = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._stream(url, data, pieces.put), self._loop)
+        try:
+            while (piece := pieces.get()) is not _STREAM_END:
+                if isinstance(piece, Exception):
+                    raise piece
+                yield piece
+        finally:
+            # Closing the iterator early closes the connection, which stops the generation on the server
+            future.cancel()
+
+
+_llm_client: LLMClient | None = None
+_llm_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    global _llm_client
+    with _llm_client_lock:
+        if _llm_client is None:
+            _llm_client = LLMClient(
+                timeout=config.llm_timeout,
+                connect_timeout=config.llm_connect_timeout,
+                max_connections=config.llm_max_connections,
+                max_retries=config.llm_max_retries,
+                retry_backoff=config.llm_retry_backoff,
+            )
+    return _llm_client
+
+
+class ResponseCache:
+    """Persistent store of raw LLM responses keyed by request, backed by SQLite with TTL and LRU eviction.
+
+    Only valid because the model servers decode deterministically (fixed seed for ExLlama, greedy for Qwen).
+    """
+
+    def __init__(self, path: str, max_entries: int = 100_000, ttl: float | None = None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(url: str, data: dict, namespace: str = "") -> str:
+        # url carries the port, data the fully formatted prompt and generation parameters
+        payload = json.dumps({"namespace": namespace, "url": url, "data": data}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+            self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+        return response
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, now, now))
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now: float):
+        if self.ttl is not None:
+            self._connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return count
+
+
+_response_cache: ResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Returns the process-wide response cache, or None if config.llm_cache_path is not set."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None and config.llm_cache_path:
+            _response_cache = ResponseCache(config.llm_cache_path, config.llm_cache_max_entries, config.llm_cache_ttl)
+    return _response_cache
+
+
+def get_json_schema(response_model: type[BaseModel] | None) -> dict | None:
+    """Schema the model server enforces while decoding, None if constrained decoding is disabled."""
+    if response_model is None or not config.constrained_decoding:
+        return None
+    return response_model.model_json_schema()
+
+
+def prepare_request(
+    user_prompt: str, system_prompt: str | None, max_new_tokens: int, response_model: type[BaseModel] | None = None
+) -> tuple[str, dict]:
     if config.inference_location == "local":
         raise ValueError("Invalid inference type")
     elif config.inference_location == "remote":
         if config.inference_type == "exllama":
             url = f"http://localhost:{config.llm_port}/generate"
-            headers = {"Content-Type": "application/json"}
             formatted_prompt = format_prompt(prompt_format, user_prompt, system_prompt, first=True)
             data = {"prompt": formatted_prompt, "max_new_tokens": max_new_tokens}
-
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-            response_text = response.text.encode("utf-8").decode("utf-8").strip()
-
         elif config.inference_type == "qwen":
             url = f"http://localhost:{config.vlm_port}/generate"
-            headers = {"Content-Type": "application/json"}
             data = {
                 "prompt": user_prompt,
                 "max_new_tokens": max_new_tokens,
                 "system_prompt": system_prompt,
             }
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-            response_list = json.loads(response.text)
-            response_text = response_list[0].strip()
         else:
             raise ValueError(f"Invalid inference type: {config.inference_type}")
+        if json_schema := get_json_schema(response_model):
+            data["json_schema"] = json_schema
+        return url, data
+    else:
+        raise ValueError(f"Invalid inference location: {config.inference_location}")
+
+
+def parse_response_body(response_text: str) -> str:
+    if config.inference_type == "qwen":
+        response_list = json.loads(response_text)
+        return response_list[0].strip()
+    else:
+        return response_text.strip()
+
+
+def clean_response(response_text: str) -> str:
+    cleaned = re.sub(r"^```[\w]*\n|```$", "", response_text.strip())
+    print(f"Response in generate_response: {cleaned}")
+
+    cleaned = re.sub(r"<think>.*?</think>", "", cleaned, flags=re.DOTALL)
+    return cleaned
+
+
+def generate_response(
+    user_prompt: str,
+    system_prompt: str = None,
+    max_new_tokens: int = config.max_new_tokens,
+    use_cache: bool = True,
+    response_model: type[BaseModel] | None = None,
+) -> str:
+    """Returns the cleaned model output.
+
+    With config.constrained_decoding set, passing response_model makes the server only generate JSON instances
+    of its schema, so parsing the output does not need the repair round trips of parse_with_retry.
+    """
+    url, data = prepare_request(user_prompt, system_prompt, max_new_tokens, response_model)
+    cache = get_response_cache() if use_cache else None
+    if cache is None:
+        return clean_response(parse_response_body(get_llm_client().post(url, data)))
+
+    key = cache.make_key(url, data, config.llm_cache_namespace)
+    response_text = cache.get(key)
+    if response_text is None:
+        response_text = get_llm_client().post(url, data)
+        cache.put(key, response_text)
+    return clean_response(parse_response_body(response_text))
+
 
-        cleaned = re.sub(r"^```[\w]*\n|```$", "", response_text)
-        print(f"Response in generate_response: {cleaned}")
+def generate_response_stream(
+    user_prompt: str,
+    system_prompt: str = None,
+    max_new_tokens: int = config.max_new_tokens,
+    response_model: type[BaseModel] | None = None,
+) -> Iterator[str]:
+    """Yields the raw model output piece by piece as it is decoded.
 
-        cleaned = re.sub(r"<think>.*?</think>", "", cleaned, flags=re.DOTALL)
-        return cleaned
+    Pass the concatenated pieces through clean_response to get what generate_response would have returned.
+    """
+    url, data = prepare_request(user_prompt, system_prompt, max_new_tokens, response_model)
+    data["stream"] = True
+    yield from get_llm_client().stream(url, data)
@@ -1,24 +1,23 @@
 import re
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 from typing import Union
 
+from rapidfuzz.distance import Levenshtein
+
 from domain.document import Document
 from settings import ABBREVIATION_DICT
 
 
-def levenshteinDistance(s1, s2):
-    if len(s1) > len(s2):
-        s1, s2 = s2, s1
+def levenshteinDistance(s1, s2, max_distance: int | None = None) -> int:
+    """
+    Edit distance between s1 and s2, computed with rapidfuzz's bit-parallel implementation.
 
-    distances = range(len(s1) + 1)
-    for i2, c2 in enumerate(s2):
-        distances_ = [i2 + 1]
-        for i1, c1 in enumerate(s1):
-            if c1 == c2:
-                distances_.append(distances[i1])
-            else:
-                distances_.append(1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
-        distances = distances_
-    return distances[-1]
+    If max_distance is given, the computation stops as soon as the distance is known to exceed it and
+    max_distance + 1 is returned, which is all a threshold check needs.
+    """
+    return Levenshtein.distance(s1, s2, score_cutoff=max_distance)
 
 
 def normalize_text(text):
@@ -38,7 +37,9 @@ def merge_document(document: Document, pages: list[int], raw: bool = False) -> s
     return doc
 
 
-def replace_abbreviations(text: str) -> tuple[str, int]:
+@lru_cache(maxsize=1)
+def get_abbreviation_pattern() -> re.Pattern:
+    """Compiles the abbreviation matcher once per process and reuses it for every replacement."""
     simple_abbreviations = [abbr for abbr in ABBREVIATION_DICT if abbr.isalnum()]
     complex_abbreviations = [abbr for abbr in ABBREVIATION_DICT if not abbr.isalnum()]
 
@@ -46,8 +47,10 @@ def replace_abbreviations(text: str) -> tuple[str, int]:
 
     complex_pattern = r"(" + "|".join(re.escape(abbr) for abbr in complex_abbreviations) + r")(?=\W|$)"
 
-    pattern = re.compile(f"{simple_pattern}|{complex_pattern}")
+    return re.compile(f"{simple_pattern}|{complex_pattern}")
 
+
+def replace_abbreviations(text: str) -> tuple[str, int]:
     count = 0
 
     def replacer(match):
@@ -55,6 +58,34 @@ def replace_abbreviations(text: str) -> tuple[str, int]:
         count += 1
         return ABBREVIATION_DICT[match.group()]
 
-    result_text = pattern.sub(replacer, text)
+    result_text = get_abbreviation_pattern().sub(replacer, text)
 
     return result_text, count
+
+
+# Non-word character that cannot occur in extracted text, so it keeps the word boundaries of the joined texts
+_BATCH_SEPARATOR = "\x00"
+
+
+def replace_abbreviations_batch(texts: list[str]) -> list[tuple[str, int]]:
+    """Replaces abbreviations in all texts with a single scan over their concatenation.
+
+    Returns:
+        list[tuple[str, int]]: Replaced text and number of replacements for each input text.
+    """
+    if not texts:
+        return []
+    if any(_BATCH_SEPARATOR in text for text in texts):
+        return [replace_abbreviations(text) for text in texts]
+
+    # Offsets of the separators, used to attribute each match to its text
+    separator_offsets = list(accumulate(len(text) + 1 for text in texts))
+    counts = [0] * len(texts)
+
+    def replacer(match):
+        counts[bisect_right(separator_offsets, match.start())] += 1
+        return ABBREVIATION_DICT[match.group()]
+
+    result_texts = get_abbreviation_pattern().sub(replacer, _BATCH_SEPARATOR.join(texts)).split(_BATCH_SEPARATOR)
+
+    return list(zip(result_texts, counts))
@@ -1,3 +1,5 @@
+from bisect import bisect_right
+from itertools import accumulate
 from enum import Enum
 import pickle
 
@@ -13,19 +15,95 @@ class Page:
             self.processed_content = processed_content
 
 
+class PageBuffer:
+    """
+    Processed content of several pages joined into one string, with the character offset of every page.
+
+    Built once per document pass, so searching across page boundaries needs no page windows, and any position in
+    the text maps back to its page by binary search. A run of pages reads the same as separator.join of their
+    contents.
+
+    The text is a plain str rather than a UTF-8 bytes buffer: its consumers search it with str methods and
+    rapidfuzz, which would otherwise decode it again, and character offsets are what they work with. get_text
+    therefore returns a new string, the buffer saves the page scans and the joining, not the copy of a slice.
+    """
+
+    def __init__(self, pages: list[Page], separator: str = " "):
+        self.page_numbers = [page.page_number for page in pages]
+        self.separator = separator
+        contents = [page.processed_content or "" for page in pages]
+        self.text = separator.join(contents)
+        # starts[i] and ends[i] delimit page i, the separators lie in between
+        self.starts = list(accumulate((len(content) + len(separator) for content in contents[:-1]), initial=0))
+        self.ends = [start + len(content) for start, content in zip(self.starts, contents)]
+        self._slots = {}
+        for slot, page_number in enumerate(self.page_numbers):
+            self._slots.setdefault(page_number, slot)
+
+    def __len__(self) -> int:
+        return len(self.page_numbers)
+
+    def __contains__(self, page_number: int) -> bool:
+        return page_number in self._slots
+
+    def page_at(self, offset: int) -> int:
+        """Number of the page that contains the character at offset, a separator belongs to the page before it."""
+        return self.page_numbers[max(bisect_right(self.starts, offset) - 1, 0)]
+
+    def get_text(self, start_page: int, end_page: int | None = None) -> str | None:
+        """Pages from start_page to end_page as they are ordered in the buffer, None if either is missing."""
+        first, last = self._slots.get(start_page), self._slots.get(start_page if end_page is None else end_page)
+        if first is None or last is None or first > last:
+            return None
+        return self.text[self.starts[first] : self.ends[last]]
+
+
 class Document:
     def __init__(self, path: str = ""):
         self.path = path
         self.pages = []
 
+    @property
+    def pages(self) -> list[Page]:
+        return self._pages
+
+    @pages.setter
+    def pages(self, pages: list[Page]):
+        self._pages = pages
+        self._page_index = None
+
+    def __setstate__(self, state: dict):
+        # Documents pickled before the page index stored the list as "pages"
+        if "pages" in state:
+            state["_pages"] = state.pop("pages")
+        state["_page_index"] = None
+        self.__dict__.update(state)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_page_index"] = None
+        return state
+
     def add_page(self, page):
         self.pages.append(page)
 
+    def _build_page_index(self):
+        self._page_index = {}
+        for position, page in enumerate(self._pages):
+            self._page_index.setdefault(page.page_number, position)
+
     def get_page(self, page_number):
-        for page in self.pages:
-            if page.page_number == page_number:
-                return page
-        return None
+        # The index maps page numbers to positions in self.pages, which callers also filter, extend, sort and
+        # replace in place. A position that no longer holds the page or a miss rebuilds it, like the linear scan.
+        if self._page_index is not None:
+            position = self._page_index.get(page_number)
+            if position is not None and position < len(self._pages):
+                page = self._pages[position]
+                if page.page_number == page_number:
+                    return page
+        self._build_page_index()
+        position = self._page_index.get(page_number)
+        return None if position is None else self._pages[position]
 
     def get_raw_content(self, page_number):
         page = self.get_page(page_number)
@@ -35,6 +113,21 @@ class Document:
         page = self.get_page(page_number)
         return page.processed_content if page else None
 
+    def to_page_buffer(self, page_numbers: list[int] | None = None, separator: str = " ") -> PageBuffer:
+        """Processed content of the given pages joined by separator (all pages in document order by default).
+
+        The buffer holds its own copy of the contents and does not follow later changes of the document, build a
+        new one after modifying pages.
+        """
+        if page_numbers is None:
+            pages = self.pages
+        else:
+            pages = [self.get_page(page_number) for page_number in page_numbers]
+            missing = [page_number for page_number, page in zip(page_numbers, pages) if page is None]
+            if missing:
+                raise ValueError(f"Pages {missing} are not in the document")
+        return PageBuffer(pages, separator)
+
     def save(self, filepath):
         with open(filepath, "wb") as file:
             pickle.dump(self, file)
@@ -19,6 +19,15 @@ class Feedback:  # TODO: Add question id and/or
             "generated_answer": self.generated_answer,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            question_id=data.get("question_id"),
+            feedback=data.get("feedback", ""),
+            score=data.get("score"),
+            generated_answer=data.get("generated_answer", ""),
+        )
+
 
 class StatementResult(Feedback):
     def __init__(
@@ -46,6 +55,17 @@ class StatementResult(Feedback):
             "generated_answer": self.generated_answer,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            statements=data.get("statements", []),
+            explanations=data.get("explanations", []),
+            verdicts=data.get("verdicts", []),
+            question_id=data.get("question_id"),
+            score=data.get("score"),
+            generated_answer=data.get("generated_answer", ""),
+        )
+
 
 class AnswerRelevanceResult(Feedback):
     def __init__(
@@ -73,6 +93,17 @@ class AnswerRelevanceResult(Feedback):
             "generated_answer": self.generated_answer,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            answer=data.get("answer"),
+            generated_questions=data.get("generated_questions", []),
+            noncommittal=data.get("noncommittal"),
+            question_id=data.get("question_id"),
+            score=data.get("score"),
+            generated_answer=data.get("generated_answer", ""),
+        )
+
 
 class ContextRelevanceResult(Feedback):
     def __init__(
@@ -97,6 +128,16 @@ class ContextRelevanceResult(Feedback):
             "generated_answer": self.generated_answer,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            relevant_sentences=data.get("relevant_sentences"),
+            irrelevant_sentences=data.get("irrelevant_sentences"),
+            question_id=data.get("question_id"),
+            score=data.get("score"),
+            generated_answer=data.get("generated_answer", ""),
+        )
+
 
 class Stats:
     def __init__(
@@ -116,3 +157,14 @@ class Stats:
             if self.retrieved_documents
             else None,
         }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            question_id=data.get("question_id"),
+            recall=data.get("recall"),
+            precision=data.get("precision"),
+            retrieved_documents=[Chunk.from_dict(doc) for doc in data["retrieved_documents"]]
+            if data.get("retrieved_documents")
+            else None,
+        )
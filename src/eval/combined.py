@@ -2,7 +2,7 @@ from .retrieval_metrics import recall, precision
 from services.retrieval import FaissService, retrieve_and_return_optimized_query
 from domain.document import Document
 from core.model import generate_response
-from core.generation import create_question_prompt_w_docs
+from core.generation import create_question_prompt_w_docs, get_answer_model
 from .generation_metrics import llm_as_a_judge
 from domain.vignette import Vignette, Question
 from domain.document import Chunk
@@ -53,6 +53,20 @@ class EvalResult:
             "retrieval_precision": self.retrieval_precision,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            feedback=data.get("feedback"),
+            question_id=data.get("question_id"),
+            score=data.get("score"),
+            generated_answer=data.get("generated_answer"),
+            optimized_query=data.get("optimized_query"),
+            reference_pages=data.get("reference_pages", []),
+            retrieved_documents=[Chunk.from_dict(doc) for doc in data.get("retrieved_documents", [])],
+            retrieval_recall=data.get("retrieval_recall"),
+            retrieval_precision=data.get("retrieval_precision"),
+        )
+
 
 def evaluate_single_combined(
     vignette: Vignette,
@@ -69,7 +83,7 @@ def evaluate_single_combined(
     retrieval_precision = precision(retrieved_documents, question.get_reference_pages())
 
     system_prompt, user_prompt = create_question_prompt_w_docs(retrieved_documents, vignette, question)
-    generated_answer = generate_response(user_prompt, system_prompt)
+    generated_answer = generate_response(user_prompt, system_prompt, response_model=get_answer_model())
     if config.reasoning:
         generated_answer = parse_with_retry(ReasoningAnswer, generated_answer)
         answer_dict = {
@@ -1,15 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 from statistics import mean
 from typing import Literal
 import json
 
 from services.retrieval import FaissService, retrieve, retrieve_and_return_optimized_query
 from core.model import generate_response
-from core.generation import create_question_prompt_w_docs
-from domain.evaluation import Feedback
+from core.generation import create_question_prompt_w_docs, get_answer_model
+from domain.evaluation import Feedback, StatementResult, AnswerRelevanceResult, ContextRelevanceResult
 from domain.document import Chunk, Document
 from settings import VIGNETTE_COLLECTION, get_page_types
 from .generation_metrics import llm_as_a_judge, faithfulness, answer_relevance, get_generated_flowchart_page_description
 from .retrieval_metrics import context_relevance, recall, precision
+from .runner import evaluate_questions, get_source_questions
 from parsing import Answer, parse_with_retry, ReasoningAnswer, ThinkingAnswer
 from settings.settings import config, settings
 from core.chunking import tables_to_chunks
@@ -61,6 +63,25 @@ class RAGASResult:
             "retrieval_precision": self.retrieval_precision,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        def load(feedback_class, key):
+            return feedback_class.from_dict(data[key]) if data.get(key) else None
+
+        return cls(
+            question_id=data.get("question_id"),
+            retrieved_documents=[Chunk.from_dict(doc) for doc in data.get("retrieved_documents", [])],
+            generated_answer=data.get("generated_answer"),
+            llm_as_a_judge_param=load(Feedback, "llm_as_judge"),
+            faithfulness_param=load(StatementResult, "faithfulness"),
+            answer_relevance_param=load(AnswerRelevanceResult, "answer_relevance"),
+            context_relevance_param=load(ContextRelevanceResult, "context_relevance"),
+            optimized_query=data.get("optimized_query", ""),
+            reference_pages=data.get("reference_pages", []),
+            retrieval_recall=data.get("retrieval_recall"),
+            retrieval_precision=data.get("retrieval_precision"),
+        )
+
 
 class FeedbackResult(Feedback):
     def __init__(
@@ -86,6 +107,17 @@ class FeedbackResult(Feedback):
             "retrieved_documents": [doc.to_dict() for doc in self.retrieved_documents],
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            feedback=data.get("feedback"),
+            question_id=data.get("question_id"),
+            score=data.get("score"),
+            generated_answer=data.get("generated_answer", ""),
+            reference_pages=data.get("reference_pages", []),
+            retrieved_documents=[Chunk.from_dict(doc) for doc in data.get("retrieved_documents", [])],
+        )
+
 
 def evaluate_single(
     vignette_id: int,
@@ -134,7 +166,7 @@ def evaluate_single(
     print(f"# of Retrieved documents: {len(retrieved_documents)}")
     print(f"Retrieved docs: {[doc.__str__() for doc in retrieved_documents]}")
     system_prompt, user_prompt = create_question_prompt_w_docs(retrieved_documents, vignette, question)
-    generated_answer = generate_response(user_prompt, system_prompt)
+    generated_answer = generate_response(user_prompt, system_prompt, response_model=get_answer_model())
     if config.reasoning:
         generated_answer = parse_with_retry(ReasoningAnswer, generated_answer)
     elif config.thinking:
@@ -159,18 +191,18 @@ def evaluate_source(
     document: Document,
     use_references_directly: bool = False,
 ) -> tuple[int, list[FeedbackResult]]:
-    all_feedbacks = []
-
-    for vignette in VIGNETTE_COLLECTION.get_vignettes():
-        for question in vignette.get_questions():
-            if question.get_source() != source:
-                continue
-
-            all_feedbacks.append(
-                evaluate_single(vignette.get_id(), question.get_id(), faiss_service, document, use_references_directly)
-            )
+    questions = get_source_questions(source)
+    all_feedbacks = evaluate_questions(
+        questions,
+        lambda vignette, question: evaluate_single(
+            vignette.get_id(), question.get_id(), faiss_service, document, use_references_directly
+        ),
+        journal_name=f"generation_{source}" + ("_references" if use_references_directly else ""),
+        result_class=FeedbackResult,
+        faiss_service=faiss_service,
+    )
 
-    print(f"Questions from {source}: {len([all_feedbacks for s in all_feedbacks if s is not None])}")
+    print(f"Questions from {source}: {len(all_feedbacks)} of {len(questions)} evaluated")
 
     try:
         avg_score = mean(
@@ -225,7 +257,7 @@ def evaluate_single_w_ragas(
 
     system_prompt, user_prompt = create_question_prompt_w_docs(retrieved_documents, vignette, question)
 
-    generated_answer = generate_response(user_prompt, system_prompt)
+    generated_answer = generate_response(user_prompt, system_prompt, response_model=get_answer_model())
     
     if config.reasoning:
         generated_answer = parse_with_retry(ReasoningAnswer, generated_answer)
@@ -246,16 +278,27 @@ def evaluate_single_w_ragas(
         }
 
 
+    # The metrics only depend on the answer and the retrieved documents, so their LLM calls can overlap.
+    # faithfulness keeps its statement extraction and verdict calls in sequence within its own task.
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="metric") as executor:
+        judge_future = executor.submit(
+            llm_as_a_judge, vignette, question, generated_answer.answer, document
+        )  # this requires real document
+        faithfulness_future = executor.submit(
+            faithfulness, vignette, question, generated_answer.answer, retrieved_documents
+        )
+        answer_relevance_future = executor.submit(
+            answer_relevance, vignette, question, generated_answer.answer, retrieved_documents
+        )
+
     return RAGASResult(
         question_id=question_id,
         generated_answer=answer_dict,
         optimized_query=optimized_query,
         reference_pages=question.get_reference_pages(),
-        llm_as_a_judge_param=llm_as_a_judge(
-            vignette, question, generated_answer.answer, document
-        ),  # this requires real document
-        faithfulness_param=faithfulness(vignette, question, generated_answer.answer, retrieved_documents),
-        answer_relevance_param=answer_relevance(vignette, question, generated_answer.answer, retrieved_documents),
+        llm_as_a_judge_param=judge_future.result(),
+        faithfulness_param=faithfulness_future.result(),
+        answer_relevance_param=answer_relevance_future.result(),
         context_relevance_param=None,  # context_relevance(vignette, question, generated_answer.answer, retrieved_documents),
         retrieved_documents=retrieved_documents,
         retrieval_recall=retrieval_recall,
@@ -296,17 +339,18 @@ def evaluate_ragas(
     all_feedbacks = []
 
     try:
-        for vignette in VIGNETTE_COLLECTION.get_vignettes():
-            for question in vignette.get_questions():
-                if question.get_source() != source:
-                    continue
-                all_feedbacks.append(
-                    evaluate_single_w_ragas(
-                        vignette.get_id(), question.get_id(), faiss_service, document, use_references_directly
-                    )
-                )
-
-        print(f"Questions from {source}: {len([all_feedbacks for s in all_feedbacks if s is not None])}")
+        questions = get_source_questions(source)
+        all_feedbacks = evaluate_questions(
+            questions,
+            lambda vignette, question: evaluate_single_w_ragas(
+                vignette.get_id(), question.get_id(), faiss_service, document, use_references_directly
+            ),
+            journal_name=f"ragas_{source}" + ("_references" if use_references_directly else ""),
+            result_class=RAGASResult,
+            faiss_service=faiss_service,
+        )
+
+        print(f"Questions from {source}: {len(all_feedbacks)} of {len(questions)} evaluated")
 
         score_keys = ["llm_as_judge", "faithfulness", "answer_relevance", "context_relevance"]
         avg_scores = compute_average_scores(all_feedbacks, score_keys)
@@ -335,18 +379,27 @@ def evaluate_ragas(
 def evaluate_ragas_qids(
     source: Literal["Handbuch", "Antibiotika"],
     faiss_service: FaissService,
+    document: Document,
     question_ids: list[int],
 ) -> tuple[dict, int, int, list[RAGASResult]]:
-    all_feedbacks = []
-
-    for vignette in VIGNETTE_COLLECTION.get_vignettes():
-        for question in vignette.get_questions():
-            if question.get_id() not in question_ids:
-                continue
-
-            all_feedbacks.append(evaluate_single_w_ragas(vignette.get_id(), question.get_id(), faiss_service))
+    questions = [
+        (vignette, question)
+        for vignette in VIGNETTE_COLLECTION.get_vignettes()
+        for question in vignette.get_questions()
+        if question.get_id() in question_ids
+    ]
+    all_feedbacks = evaluate_questions(
+        questions,
+        lambda vignette, question: evaluate_single_w_ragas(
+            vignette.get_id(), question.get_id(), faiss_service, document
+        ),
+        # Not shared with evaluate_ragas, which evaluates other questions with other arguments
+        journal_name=f"ragas_qids_{source}",
+        result_class=RAGASResult,
+        faiss_service=faiss_service,
+    )
 
-    print(f"Questions from {source}: {len([all_feedbacks for s in all_feedbacks if s is not None])}")
+    print(f"Questions from {source}: {len(all_feedbacks)} of {len(questions)} evaluated")
 
     score_keys = ["llm_as_judge", "faithfulness", "answer_relevance", "context_relevance"]
     try:
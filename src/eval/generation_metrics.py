@@ -55,7 +55,7 @@ def llm_as_a_judge(vignette: Vignette, question: Question, generated_answer: str
         generated_answer=generated_answer,
     )
 
-    eval_result = generate_response(eval_prompt)
+    eval_result = generate_response(eval_prompt, response_model=Feedback_Parsing)
     try:
         eval_result = parse_with_retry(Feedback_Parsing, eval_result)
     except Exception as e:
@@ -71,7 +71,7 @@ def extract_statements_from_answer(vignette: Vignette, question: Question, gener
     Question: {question.get_question()}
     Answer: {generated_answer}
     """
-    response = generate_response(user_prompt, EXTRACT_STATEMENTS_PROMPT)
+    response = generate_response(user_prompt, EXTRACT_STATEMENTS_PROMPT, response_model=Statements)
     try:
         statements = parse_with_retry(Statements, response)
         return statements.statements
@@ -90,7 +90,7 @@ def faithfulness(
     Question: {question.get_question()}
     Statements:\n{"\n".join(["Statement: " + statement for statement in statements])}
     """
-    response = generate_response(user_prompt, FAITHFULNESS_PROMPT)
+    response = generate_response(user_prompt, FAITHFULNESS_PROMPT, response_model=ResultsResponse)
     try:
         result_response = parse_with_retry(ResultsResponse, response)
         results = result_response.results
@@ -136,7 +136,7 @@ def answer_relevance(
 
     generated_questions = []
 
-    response = generate_response(user_prompt, ANSWER_RELEVANCE_PROMPT)
+    response = generate_response(user_prompt, ANSWER_RELEVANCE_PROMPT, response_model=AnswerRelevanceResultResponse)
     try:
         response = parse_with_retry(AnswerRelevanceResultResponse, response)
     except Exception as e:
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import threading
+
+from settings.settings import config, Config
+
+# Settings that change how fast a run goes but not its results
+_RUNTIME_FIELDS = {
+    "eval_max_workers",
+    "eval_question_timeout",
+    "evaluation_journal_dir_raw",
+    "llm_timeout",
+    "llm_connect_timeout",
+    "llm_max_connections",
+    "llm_max_retries",
+    "llm_retry_backoff",
+}
+
+
+def compute_config_hash(cfg: Config = config) -> str:
+    payload = {key: value for key, value in cfg.model_dump().items() if key not in _RUNTIME_FIELDS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class EvaluationJournal:
+    """
+    Append-only JSONL file with one finished evaluation result per line.
+
+    Entries are keyed by (run hash, vignette id, question id), so a restarted run with the same configuration and
+    index can skip the questions it already evaluated. A partially written last line from a crash is ignored.
+    """
+
+    def __init__(self, path: str, config_hash: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.config_hash = config_hash
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[int, int], dict] = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "rb+") as file:
+            # Terminates a line cut off by a crash so the next append starts on its own line
+            if file.seek(0, os.SEEK_END) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line_number, line in enumerate(file, start=1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping unreadable line {line_number} in {self.path}")
+                    continue
+                if entry.get("config_hash") == self.config_hash:
+                    self._entries[(entry["vignette_id"], entry["question_id"])] = entry["result"]
+        print(f"Loaded {len(self._entries)} finished questions from {self.path}")
+
+    def get(self, vignette_id: int, question_id: int) -> dict | None:
+        return self._entries.get((vignette_id, question_id))
+
+    def append(self, vignette_id: int, question_id: int, result: dict):
+        line = json.dumps(
+            {
+                "config_hash": self.config_hash,
+                "vignette_id": vignette_id,
+                "question_id": question_id,
+                "result": result,
+            },
+            ensure_ascii=False,
+            default=str,
+        )
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self._entries[(vignette_id, question_id)] = result
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def compute_run_hash(faiss_service=None, cfg: Config = config) -> str | None:
+    """
+    Hash of everything that determines the results of an evaluation run: the config and the index searched.
+
+    The index is identified by the service class and its version, the content hash of the indexed chunks, so runs
+    against a flat and a hierarchical index or against a re-chunked document never share results. Returns None for
+    a service without a version, whose results cannot be told apart.
+    """
+    index_key = None
+    if faiss_service is not None:
+        version = getattr(faiss_service, "version", None)
+        if version is None:
+            return None
+        index_key = f"{type(faiss_service).__name__}:{version}"
+    config_hash = compute_config_hash(cfg)
+    if index_key is None:
+        return config_hash
+    return hashlib.sha256(f"{config_hash}:{index_key}".encode("utf-8")).hexdigest()[:16]
+
+
+def get_journal(name: str, faiss_service=None) -> EvaluationJournal | None:
+    """
+    Returns the journal of the named evaluation for the current config and index, or None if journaling is disabled.
+
+    Entries written under another config or index are ignored when the journal is loaded.
+    """
+    if not config.evaluation_journal_dir:
+        return None
+    run_hash = compute_run_hash(faiss_service)
+    if run_hash is None:
+        print(f"Journaling disabled for {name}: {type(faiss_service).__name__} has no index version")
+        return None
+    return EvaluationJournal(os.path.join(config.evaluation_journal_dir, f"{name}_{run_hash}.jsonl"), run_hash)
@@ -7,6 +7,7 @@ from domain.evaluation import Stats
 from services.retrieval import FaissService, retrieve
 from settings import VIGNETTE_COLLECTION
 from .retrieval_metrics import recall, precision
+from .runner import evaluate_questions, get_source_questions
 
 
 def get_references_w_id(vignette_id, question_id) -> list[int]:
@@ -35,18 +36,16 @@ def evaluate_source(
     source: Literal["Handbuch", "Antibiotika"],
     faiss_service: FaissService,
 ) -> tuple[Stats, list[Stats]]:
-    all_stats = []
-
-    for vignette in VIGNETTE_COLLECTION.get_vignettes():
-        for question in vignette.get_questions():
-            print(f"Processing question {question.get_id()} from {source}")
-            if question.get_source() != source:
-                continue
-
-            retrieved_documents = retrieve(vignette, question, faiss_service)
-            all_stats.append(evaluate_single(question, retrieved_documents))
+    questions = get_source_questions(source)
+    all_stats = evaluate_questions(
+        questions,
+        lambda vignette, question: evaluate_single(question, retrieve(vignette, question, faiss_service)),
+        journal_name=f"retrieval_{source}",
+        result_class=Stats,
+        faiss_service=faiss_service,
+    )
 
-    print(f"Questions from {source}: {len([all_stats for s in all_stats if s is not None])}")
+    print(f"Questions from {source}: {len(all_stats)} of {len(questions)} evaluated")
     return Stats(
         question_id=-1,
         recall=mean([stat.recall for stat in all_stats if stat is not None]),
@@ -1,3 +1,9 @@
+import time
+from statistics import mean
+
+import faiss
+import numpy as np
+
 from domain.vignette import Question, Vignette
 from domain.document import Chunk
 from domain.evaluation import Stats, ContextRelevanceResult
@@ -43,13 +49,50 @@ def precision(retrieved_passages: list[Chunk], reference_pages: list[int]) -> St
     return relevant_retrieved_count / total_retrieved_count
 
 
+def ann_recall_and_latency(
+    index: faiss.Index, baseline_index: faiss.Index, query_embeddings: np.ndarray, k: int
+) -> dict[str, float]:
+    """
+    Compares an approximate index against exact search on the same embeddings.
+
+    Args:
+        index (faiss.Index): Index under test.
+        baseline_index (faiss.Index): Exact index, e.g. IndexFlatIP, providing the reference neighbours.
+        query_embeddings (np.ndarray): (n, d) query embeddings.
+        k (int): Number of neighbours.
+
+    Returns:
+        dict[str, float]: recall@k against the baseline and single-query search latencies in milliseconds.
+    """
+    _, expected = baseline_index.search(query_embeddings, k)
+
+    recalls = []
+    latencies = []
+    for query_embedding, expected_indices in zip(query_embeddings, expected):
+        start = time.perf_counter()
+        _, I = index.search(query_embedding[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        expected_indices = set(expected_indices[expected_indices >= 0].tolist())
+        if expected_indices:
+            recalls.append(len(expected_indices & set(I[0].tolist())) / len(expected_indices))
+
+    return {
+        "recall_at_k": mean(recalls) if recalls else 0.0,
+        "mean_latency_ms": mean(latencies),
+        "p95_latency_ms": float(np.percentile(latencies, 95)),
+    }
+
+
 def context_relevance(
     vignette: Vignette, question: Question, generated_answer: str, retrieved_documents: list[Chunk]
 ) -> ContextRelevanceResult:
     context = ". ".join([doc.text for doc in retrieved_documents])
     user_prompt = f"Context: {context}\nQuestion: {question.get_question()}"
 
-    response = generate_response(user_prompt, CONTEXT_RELEVANCE_PROMPT, max_new_tokens=4096)
+    response = generate_response(
+        user_prompt, CONTEXT_RELEVANCE_PROMPT, max_new_tokens=4096, response_model=ContextRelevanceResultResponse
+    )
 
     try:
         response = parse_with_retry(ContextRelevanceResultResponse, response)
@@ -0,0 +1,146 @@
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from domain.vignette import Question, Vignette
+from .journal import get_journal
+from settings import VIGNETTE_COLLECTION
+from settings.settings import config
+
+T = TypeVar("T")
+
+
+def get_source_questions(source: str) -> list[tuple[Vignette, Question]]:
+    return [
+        (vignette, question)
+        for vignette in VIGNETTE_COLLECTION.get_vignettes()
+        for question in vignette.get_questions()
+        if question.get_source() == source
+    ]
+
+
+async def _run_all(
+    tasks: list[Callable[[], T]], labels: list[str], max_workers: int, timeout: float | None
+) -> list[T | None]:
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_workers)
+
+    # Not a context manager, its shutdown would wait for the threads of timed out tasks
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="eval")
+
+    def release(future: asyncio.Future):
+        semaphore.release()
+        # Retrieved so the error of a task that finished after its timeout is not reported as unhandled
+        if not future.cancelled():
+            future.exception()
+
+    async def run_one(task: Callable[[], T], label: str) -> T | None:
+        await semaphore.acquire()
+        future = loop.run_in_executor(executor, task)
+        # The slot is freed when the thread returns rather than at the timeout, so a task never waits in the executor
+        # queue behind a timed out one and its timeout only counts its own run time
+        future.add_done_callback(release)
+        start = time.perf_counter()
+        done, _ = await asyncio.wait({future}, timeout=timeout)
+        if not done:
+            print(f"Evaluation of {label} timed out after {timeout}s")
+            return None
+        try:
+            result = future.result()
+        except Exception:
+            print(f"Evaluation of {label} failed:")
+            traceback.print_exc()
+            return None
+        print(f"Evaluated {label} in {time.perf_counter() - start:.1f}s")
+        return result
+
+    try:
+        return await asyncio.gather(*(run_one(task, label) for task, label in zip(tasks, labels)))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def evaluate_in_parallel(
+    tasks: list[Callable[[], T]],
+    labels: list[str] | None = None,
+    max_workers: int | None = None,
+    timeout: float | None = None,
+) -> list[T | None]:
+    """
+    Runs independent evaluation tasks concurrently on a bounded thread pool.
+
+    Parameters:
+        tasks (list): Zero-argument callables, usually one per question.
+        labels (list): Names used in the log, defaults to the task positions.
+        max_workers (int): Number of tasks running at once, defaults to config.eval_max_workers.
+        timeout (float): Seconds a task may run, defaults to config.eval_question_timeout.
+
+    Returns:
+        list: Results in the order of tasks, None for tasks that failed or timed out.
+    """
+    labels = labels or [f"task {i}" for i in range(len(tasks))]
+    max_workers = max_workers or config.eval_max_workers
+    timeout = timeout if timeout is not None else config.eval_question_timeout
+    # A timed out task keeps its thread until the blocking call returns, its result is discarded
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        # asyncio.run is not allowed inside a running event loop (e.g. a notebook), so the tasks get a loop in a thread
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="eval-loop") as loop_thread:
+            return loop_thread.submit(asyncio.run, _run_all(tasks, labels, max_workers, timeout)).result()
+    # Outside the except block, so the traceback of a failed task is not chained to the RuntimeError above
+    return asyncio.run(_run_all(tasks, labels, max_workers, timeout))
+
+
+def evaluate_questions(
+    questions: list[tuple[Vignette, Question]],
+    evaluate: Callable[[Vignette, Question], T],
+    journal_name: str | None = None,
+    result_class: type | None = None,
+    faiss_service=None,
+) -> list[T]:
+    """
+    Evaluates questions in parallel, skipping those already recorded in the evaluation journal.
+
+    Parameters:
+        questions (list): (vignette, question) pairs to evaluate.
+        evaluate (callable): Evaluates one question, its result needs to_dict if journal_name is set.
+        journal_name (str): Name of the journal to resume from and append to, None disables journaling.
+        result_class (type): Class with from_dict to restore journaled results.
+        faiss_service: Index the questions are evaluated against, journaled results of other indexes are not reused.
+
+    Returns:
+        list: Results of the successfully evaluated questions in question order, journaled ones included.
+    """
+    journal = get_journal(journal_name, faiss_service) if journal_name else None
+
+    results = [None] * len(questions)
+    pending = []
+    for position, (vignette, question) in enumerate(questions):
+        entry = journal.get(vignette.get_id(), question.get_id()) if journal is not None else None
+        if entry is not None:
+            results[position] = result_class.from_dict(entry)
+        else:
+            pending.append(position)
+    if journal is not None:
+        print(f"Resuming {journal_name}: {len(questions) - len(pending)} done, {len(pending)} to evaluate")
+
+    def task(vignette: Vignette, question: Question) -> T:
+        result = evaluate(vignette, question)
+        # Written as soon as the question finishes so a crash later in the run keeps it
+        if journal is not None and result is not None:
+            journal.append(vignette.get_id(), question.get_id(), result.to_dict())
+        return result
+
+    new_results = evaluate_in_parallel(
+        [lambda vignette=questions[i][0], question=questions[i][1]: task(vignette, question) for i in pending],
+        labels=[f"question {questions[i][1].get_id()}" for i in pending],
+    )
+    for position, result in zip(pending, new_results):
+        results[position] = result
+
+    return [result for result in results if result is not None]
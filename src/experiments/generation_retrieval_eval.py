@@ -21,10 +21,11 @@ from core.generation import describe_table_for_generation
 from domain.document import ChunkType, Chunk
 
 from settings.settings import settings
-from settings import get_page_types, config, VIGNETTE_COLLECTION
+from settings import get_page_types, config
 from eval.combined import evaluate_single_combined, EvalResult
 
 from eval.generation import evaluate_ragas
+from eval.runner import evaluate_questions, get_source_questions
 
 
 # TODO: do it somewhere else in init
@@ -95,15 +96,14 @@ def evaluate_source_combined(
     """
     Evaluate both retrieval and generation for a given source using the combined evaluation function.
     """
-    all_feedbacks = []
-
-    for vignette in VIGNETTE_COLLECTION.get_vignettes():
-        for question in vignette.get_questions():
-            if question.get_source() != source:
-                continue
-
-            eval_result = evaluate_single_combined(vignette, question, faiss_service, document)
-            all_feedbacks.append(eval_result)
+    questions = get_source_questions(source)
+    all_feedbacks = evaluate_questions(
+        questions,
+        lambda vignette, question: evaluate_single_combined(vignette, question, faiss_service, document),
+        journal_name=f"combined_{source}",
+        result_class=EvalResult,
+        faiss_service=faiss_service,
+    )
 
     try:
         avg_score = mean([float(eval_result.score) for eval_result in all_feedbacks if eval_result.score is not None])
@@ -0,0 +1,92 @@
+import sys
+import os
+import json
+import time
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.getcwd(), ".."))
+sys.path.append(project_root)
+
+import faiss
+
+from core.chunking import load_saved_chunks
+from core.embedding import embed_chunks
+from core.utils import replace_abbreviations_batch
+from services.retrieval import create_faiss_index, reorder_flowchart_chunks
+from eval.retrieval_metrics import ann_recall_and_latency
+
+from settings.settings import settings
+from settings import config, VIGNETTE_COLLECTION
+
+
+import mlflow
+
+mlflow.set_tracking_uri(uri="http://127.0.0.1:8080")
+mlflow.set_experiment("Index Backends")
+
+# Recall is measured against exact search, so the vignette questions only serve as realistic queries
+all_chunks = reorder_flowchart_chunks(load_saved_chunks(config.saved_chunks_path))
+embeddings = embed_chunks([text for text, _ in all_chunks], task_type="search_document")
+
+questions = [
+    question.get_question() for vignette in VIGNETTE_COLLECTION.get_vignettes() for question in vignette.get_questions()
+]
+queries = [query for query, _ in replace_abbreviations_batch(questions)]
+query_embeddings = embed_chunks(queries, task_type="search_query")
+print(f"Number of chunks: {len(all_chunks)}, number of queries: {len(queries)}")
+
+baseline_index = create_faiss_index(embeddings, "flat")
+
+index_configurations = [
+    ("flat", {}),
+    ("hnsw", {"hnsw_ef_search": 16}),
+    ("hnsw", {"hnsw_ef_search": 64}),
+    ("ivf_flat", {"ivf_nprobe": 1}),
+    ("ivf_flat", {"ivf_nprobe": 8}),
+    ("ivf_pq", {"ivf_nprobe": 8}),
+]
+
+results = []
+for index_type, search_params in index_configurations:
+    for param, value in search_params.items():
+        setattr(config, param, value)
+    config.index_type = index_type
+
+    start = time.perf_counter()
+    index = create_faiss_index(embeddings, index_type)
+    build_time = time.perf_counter() - start
+
+    stats = ann_recall_and_latency(index, baseline_index, query_embeddings, config.top_k)
+    result = {
+        "index_type": index_type,
+        "search_params": search_params,
+        "build_time_s": build_time,
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+        **stats,
+    }
+    print(result)
+    results.append(result)
+
+output_file = f"index_backend_eval_{int(time.time())}.json"
+output_path = os.path.join(settings.results_path, output_file)
+with open(output_path, "w") as file:
+    json.dump(
+        {
+            "num_chunks": len(all_chunks),
+            "num_queries": len(queries),
+            "top_k": config.top_k,
+            "results": results,
+        },
+        file,
+        indent=4,
+    )
+
+with mlflow.start_run():
+    mlflow.log_params({"num_chunks": len(all_chunks), "num_queries": len(queries), "top_k": config.top_k})
+    for result in results:
+        name = result["index_type"] + "".join(f"_{k}{v}" for k, v in result["search_params"].items())
+        mlflow.log_metric(f"{name}_recall_at_k", result["recall_at_k"])
+        mlflow.log_metric(f"{name}_mean_latency_ms", result["mean_latency_ms"])
+    mlflow.log_artifact(output_path)
+
+print("Results are saved in: ", output_path)
@@ -11,7 +11,7 @@ from langchain_ollama import ChatOllama
 # Get the absolute path to the project root directory
 project_root = os.path.abspath(os.path.join(os.getcwd(), ".."))
 sys.path.append(project_root)
-from core.document import load_document, process_document  # noqa: E402
+from core.document import load_document, process_document, calculate_num_changes  # noqa: E402
 
 
 def report_replaced_abbreviation_count(document):
@@ -79,39 +79,6 @@ def improve_pdf_output(text: str):
     return chain.invoke(messages)
 
 
-def levenshteinDistance(s1, s2):
-    if len(s1) > len(s2):
-        s1, s2 = s2, s1
-
-    distances = range(len(s1) + 1)
-    for i2, c2 in enumerate(s2):
-        distances_ = [i2 + 1]
-        for i1, c1 in enumerate(s1):
-            if c1 == c2:
-                distances_.append(distances[i1])
-            else:
-                distances_.append(1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
-        distances = distances_
-    return distances[-1]
-
-
-def normalize_text(text):
-    # Remove all whitespace and punctuation, but keep numbers and letters
-    return re.sub(r"[^a-zA-Z0-9]", "", text)
-
-
-def has_significant_changes(original, modified, threshold=20):
-    # Normalize texts by removing whitespace and punctuation
-    normalized_original = normalize_text(original)
-    normalized_modified = normalize_text(modified)
-
-    # Calculate Levenshtein distance on normalized texts
-    distance = levenshteinDistance(normalized_original, normalized_modified)
-
-    # Check if distance is within an acceptable threshold
-    return distance  # distance > threshold
-
-
 significantly_changed = {}
 NUM_CHANGES_THRESHOLD = 20  # Number of changes (on top of whitespaces) that are considered significant
 
@@ -127,7 +94,8 @@ for page in document.pages:
         except KeyboardInterrupt:
             print(f"Error processing page {page.page_number}. Skipping")
         page.processed_content = output["output"]
-        num_changes = has_significant_changes(content_before, page.processed_content)
+        # Counting stops above the threshold, the exact number of a rejected page is not needed
+        num_changes = calculate_num_changes(content_before, page.processed_content, NUM_CHANGES_THRESHOLD)
         print(f"Number of changes made apart from whitespace injecting: {num_changes}")
         if num_changes > NUM_CHANGES_THRESHOLD:
             print(f"Significant changes detected on page {page.page_number}. Won't save.")
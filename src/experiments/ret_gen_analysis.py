@@ -43,7 +43,9 @@ for optim_method in [None]:  # "stepback", None, "hypothetical_document", "decom
         config.optimization_method = None
         config.use_original_query_only = True
 
-    avg_score, all_feedbacks = evaluate_ragas_qids("Handbuch", faiss_service, question_ids_w_good_retrieval)
+    avg_score, _, _, all_feedbacks = evaluate_ragas_qids(
+        "Handbuch", faiss_service, document, question_ids_w_good_retrieval
+    )
 
     result_dict = {
         "config": config.model_dump(),
@@ -20,3 +20,30 @@ from .models import (
     FollowUpQuestion,
 )
 from .parse_try_fix import parse_with_retry, get_format_instructions
+from .streaming import IncrementalJsonParser, parse_stream
+
+__all__ = [
+    "Answer",
+    "ReasoningAnswer",
+    "ThinkingAnswer",
+    "Feedback",
+    "Summary",
+    "Statements",
+    "StatementResult",
+    "ResultsResponse",
+    "AnswerRelevanceResultResponse",
+    "ContextRelevanceResultResponse",
+    "ParaphrasedGroundTruth",
+    "WhitespaceInjectionResponse",
+    "TableText",
+    "TableDescription",
+    "TableMarkdown",
+    "FlowchartDescription",
+    "TextInFlowchartPage",
+    "RewrittenQuestion",
+    "FollowUpQuestion",
+    "parse_with_retry",
+    "get_format_instructions",
+    "IncrementalJsonParser",
+    "parse_stream",
+]
@@ -67,7 +67,8 @@ def parse_with_retry(model: type[BaseModel], response: str, max_retries: int = 4
         user_prompt = FIX_OUTPUT_PROMPT.format(
             instructions=get_format_instructions(model), completion=response, error=error_message
         )
-        response = generate_response(user_prompt, SYSTEM_PROMPT, max_new_tokens=2048)
+        # With constrained decoding the repaired output matches the schema, so this runs at most once
+        response = generate_response(user_prompt, SYSTEM_PROMPT, max_new_tokens=2048, response_model=model)
 
     parsed, _ = try_parse_result(response, model)
     return parsed
@@ -0,0 +1,157 @@
+import json
+from typing import Any, Iterable, Iterator
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from core.model import clean_response
+from .parse_try_fix import parse_with_retry
+
+
+class IncrementalJsonParser:
+    """
+    Parses a model response into a pydantic model while it is being generated.
+
+    Text before the first "{" (code fences, <think> blocks) is skipped. Every top-level field is decoded and
+    validated against its annotation as soon as its value is complete, and the parser is done once the closing
+    brace of the object arrives, so the rest of the generation can be cancelled.
+    """
+
+    def __init__(self, model: type[BaseModel]):
+        self.model = model
+        self.text = ""
+        self.fields: dict[str, Any] = {}
+        self.done = False
+        self.failed = False
+        self._adapters = {name: TypeAdapter(field.annotation) for name, field in model.model_fields.items()}
+        self._start = None
+        self._end = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, piece: str) -> list[tuple[str, Any]]:
+        """Consumes the next piece of the response and returns the top-level fields it completed."""
+        self.text += piece
+        if self.done or (self._start is None and not self._find_start()):
+            return []
+
+        completed = []
+        text = self.text
+        i = self._pos
+        while i < len(text) and not self.done:
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._key is None:
+                        self._key = json.loads(text[self._key_start : i + 1])
+                    elif self._depth == 1:
+                        completed.append(self._complete(i + 1))
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+                elif self._depth == 1:
+                    self._value_start = i
+            elif char in "{[":
+                if self._depth == 1:
+                    self._value_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._value_start is not None:
+                    completed.append(self._complete(i + 1))
+                elif self._depth == 0:
+                    # A number, boolean or null as the last value is only terminated by the closing brace
+                    if self._value_start is not None:
+                        completed.append(self._complete(i))
+                    self._end = i + 1
+                    self.done = True
+            elif self._depth == 1:
+                if char == ",":
+                    if self._value_start is not None:
+                        completed.append(self._complete(i))
+                elif self._key is not None and self._value_start is None and not char.isspace() and char != ":":
+                    self._value_start = i
+            i += 1
+        self._pos = i
+        return [field for field in completed if field is not None]
+
+    def _find_start(self) -> bool:
+        while True:
+            brace = self.text.find("{", self._pos)
+            think = self.text.find("<think>", self._pos)
+            if think != -1 and (brace == -1 or think < brace):
+                think_end = self.text.find("</think>", think)
+                if think_end == -1:
+                    self._pos = think
+                    return False
+                self._pos = think_end + len("</think>")
+                continue
+            if brace == -1:
+                # The next piece may complete a "<think>" tag that starts at the end of this one
+                self._pos = max(self._pos, len(self.text) - len("<think>") + 1)
+                return False
+            self._start = self._pos = brace
+            return True
+
+    def _complete(self, end: int) -> tuple[str, Any] | None:
+        key, value_text = self._key, self.text[self._value_start : end].strip()
+        self._key = self._value_start = None
+        try:
+            value = json.loads(value_text)
+            if key in self._adapters:
+                value = self._adapters[key].validate_python(value)
+        except (json.JSONDecodeError, ValidationError) as e:
+            print(f"Invalid value for {key} in streamed response: {e}")
+            # No more fields are emitted, feed only collects the rest of the text for the repair of the full response
+            self.failed = self.done = True
+            return None
+        self.fields[key] = value
+        return key, value
+
+    def result(self) -> BaseModel | None:
+        if not self.done or self.failed:
+            return None
+        try:
+            return self.model.model_validate(json.loads(self.text[self._start : self._end]))
+        except (json.JSONDecodeError, ValidationError) as e:
+            print(f"Failed to validate streamed response: {e}")
+            return None
+
+
+def parse_stream(
+    model: type[BaseModel], pieces: Iterable[str], parser: IncrementalJsonParser | None = None
+) -> Iterator[tuple[str, Any]]:
+    """
+    Yields (field, value) for each top-level field of the streamed response as soon as it is complete.
+
+    The pieces are no longer consumed once the object is closed, closing a generate_response_stream iterator
+    there cancels the rest of the generation. The last item is ("result", parsed model), which falls back to
+    parse_with_retry on the full text if the streamed JSON was incomplete or invalid. A field that fails
+    validation stops the yielded fields, but the stream is still read to its end for that fallback.
+    """
+    parser = parser or IncrementalJsonParser(model)
+    pieces = iter(pieces)
+    try:
+        for piece in pieces:
+            yield from parser.feed(piece)
+            # After an invalid field the generation runs to the end, parse_with_retry needs the whole response
+            if parser.done and not parser.failed:
+                break
+    finally:
+        if hasattr(pieces, "close"):
+            pieces.close()
+
+    parsed = parser.result()
+    if parsed is None:
+        parsed = parse_with_retry(model, clean_response(parser.text))
+    yield "result", parsed
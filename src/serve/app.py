@@ -1,5 +1,6 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -8,6 +9,12 @@ import uvicorn
 from pydantic import BaseModel
 import sys
 import os
+import json
+import asyncio
+import argparse
+import shutil
+import tempfile
+from contextlib import asynccontextmanager
 from typing import Any
 
 # Get the absolute path to the project root directory
@@ -19,12 +26,29 @@ from settings import settings, config
 # Setup
 from core.chunking import load_saved_chunks
 from services.retrieval import FaissService, _retrieve, reorder_flowchart_chunks
-from services.question_answering import generate_rag_answer, generate_followup_questions_if_needed, ConversationService
+from services.question_answering import (
+    generate_rag_answer,
+    generate_followup_questions_if_needed,
+    stream_rag_answer,
+    ConversationService,
+    ConversationBusyError,
+)
+
+# Set by the multi-worker launcher below, workers memory-map the snapshot the parent built instead of re-embedding
+INDEX_SNAPSHOT_ENV = "SERVE_INDEX_SNAPSHOT"
+
+
+def build_faiss_service() -> FaissService:
+    faiss_service = FaissService()
+    if snapshot_path := os.environ.get(INDEX_SNAPSHOT_ENV):
+        faiss_service.load_snapshot(snapshot_path)
+    else:
+        all_chunks = reorder_flowchart_chunks(load_saved_chunks(config.saved_chunks_path))
+        faiss_service.create_index(all_chunks)
+    return faiss_service
 
-_all_chunks = load_saved_chunks(config.saved_chunks_path)
-all_chunks = reorder_flowchart_chunks(_all_chunks)
-faiss_service = FaissService()
-faiss_service.create_index(all_chunks)
+
+faiss_service = build_faiss_service()
 
 
 class DetailUpdatePayload(BaseModel):
@@ -34,7 +58,17 @@ class DetailUpdatePayload(BaseModel):
 conversation_service = ConversationService()
 ConversationService.document_index = faiss_service
 
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Picks up conversations left generating by a crashed or restarted worker
+    resume_task = asyncio.create_task(conversation_service.resume_interrupted())
+    yield
+    resume_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # or restrict to your frontend URL
@@ -57,7 +91,7 @@ class Question(BaseModel):
 async def retrieve_documents(request: Request):
     question = await request.json()
     question = question["text"]
-    docs = _retrieve(question, faiss_service)
+    docs = await run_in_threadpool(_retrieve, question, faiss_service, use_cache=True)
     return JSONResponse({"message": [doc.to_dict() for doc in docs]})
 
 
@@ -65,7 +99,16 @@ async def retrieve_documents(request: Request):
 async def answer_question(request: Request):
     question = await request.json()
     question = question["text"]
-    return {"answer": generate_rag_answer(question, faiss_service)}
+    return {"answer": await run_in_threadpool(generate_rag_answer, question, faiss_service)}
+
+
+@app.post("/answer/stream")
+async def stream_answer(request: Request):
+    question = await request.json()
+    question = question["text"]
+    # The sync generator is iterated in the threadpool, so it does not block the event loop
+    events = (json.dumps(event, ensure_ascii=False) + "\n" for event in stream_rag_answer(question, faiss_service))
+    return StreamingResponse(events, media_type="application/x-ndjson")
 
 
 @app.post("/conversations")
@@ -81,8 +124,9 @@ async def create_conversation(request: Request):
     return JSONResponse(content=[], status_code=400)
 
 
+# Runs on the event loop rather than the threadpool, the generation tasks modify conversations on the loop
 @app.get("/conversations/{conversation_id}")
-def get_conversation(conversation_id):
+async def get_conversation(conversation_id: str):
     conversation = conversation_service.get_conversation(conversation_id)
 
     if conversation is not None:
@@ -91,19 +135,65 @@ def get_conversation(conversation_id):
         return JSONResponse(content={}, status_code=404)
 
 
+@app.get("/conversations/{conversation_id}/stream")
+async def stream_conversation(conversation_id: str):
+    if conversation_service.get_conversation(conversation_id) is None:
+        return JSONResponse(content={}, status_code=404)
+    # One line per change until the conversation is no longer generating
+    snapshots = (
+        json.dumps(conversation, ensure_ascii=False) + "\n"
+        async for conversation in conversation_service.watch_conversation(conversation_id)
+    )
+    return StreamingResponse(snapshots, media_type="application/x-ndjson")
+
+
 @app.post("/conversations/{conversation_id}/details/{detail_id}")
 async def update_detail(conversation_id: str, detail_id: str, payload: DetailUpdatePayload):
     selected_value = payload.data["art"]
     print(f"Conversation ID: {conversation_id}, Detail ID: {detail_id}, Selected Value: {selected_value}")
     try:
-        updated_conversation_state = conversation_service.update_conversation_detail(
+        updated_conversation_state = await conversation_service.update_conversation_detail(
             conversation_id, detail_id, selected_value
         )
+        if updated_conversation_state is None:
+            return JSONResponse(content={}, status_code=404)
         return JSONResponse(content=updated_conversation_state, status_code=200)
     except HTTPException as e:
         # Forward HTTP exceptions (like 404 Not Found) from the service
         return JSONResponse(content={"error": e.detail}, status_code=e.status_code)
+    except ConversationBusyError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=409)
     except Exception as e:
         # Catch unexpected errors
         print(f"Error updating detail: {e}")  # Log the error
         return JSONResponse(content={"error": "Internal server error"}, status_code=500)
+
+
+if __name__ == "__main__":
+    # Multi-worker mode: python -m serve.app --workers 4
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7001)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if config.conversation_store == "memory":
+            raise ValueError("Several workers need a shared conversation store, set conversation_store: sqlite")
+        # The index was built at import, workers load its snapshot so the read-only pages are shared via the page cache
+        tmp_dir = None
+        if faiss_service.snapshot_path is None:
+            tmp_dir = tempfile.mkdtemp(prefix="index_snapshot_")
+            faiss_service.save_snapshot(os.path.join(tmp_dir, faiss_service.version))
+        os.environ[INDEX_SNAPSHOT_ENV] = faiss_service.snapshot_path
+        # The parent only supervises the workers, it does not need its own copy of the index and chunks
+        faiss_service.index = faiss_service.chunks = faiss_service.retrieval_strings = None
+        try:
+            uvicorn.run(
+                f"{__spec__.name if __spec__ else 'app'}:app", host=args.host, port=args.port, workers=args.workers
+            )
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -1,10 +1,17 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import FastAPI
 import uvicorn
+import asyncio
+import json
+import queue
+import threading
+import time
+from collections import deque
 
 from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Cache, ExLlamaV2Tokenizer
-from exllamav2.generator import ExLlamaV2DynamicGenerator
+from exllamav2.generator import ExLlamaV2DynamicGenerator, ExLlamaV2DynamicJob
+from exllamav2.generator.filters import ExLlamaV2Filter
 
 import sys
 import os
@@ -55,17 +62,228 @@ prompt_format = PromptFormat_llama3()
 add_bos, add_eos, encode_special_tokens = prompt_format.encoding_options()
 stop_conditions = prompt_format.stop_conditions(tokenizer)
 
+class JsonSchemaFilter(ExLlamaV2Filter):
+    """Only allows tokens that continue a JSON instance of the given schema. Needs lm-format-enforcer."""
+
+    _tokenizer_data = None
+
+    def __init__(self, json_schema: dict):
+        super().__init__(model, tokenizer)
+        from lmformatenforcer import JsonSchemaParser, TokenEnforcer
+        from lmformatenforcer.integrations.exllamav2 import build_token_enforcer_tokenizer_data
+
+        # Walking the vocabulary is slow, so it happens once on the first constrained request
+        if JsonSchemaFilter._tokenizer_data is None:
+            JsonSchemaFilter._tokenizer_data = build_token_enforcer_tokenizer_data(tokenizer)
+        self.token_enforcer = TokenEnforcer(JsonSchemaFilter._tokenizer_data, JsonSchemaParser(json_schema))
+        self.token_sequence = []
+
+    def begin(self, prefix_str):
+        self.token_sequence = []
+
+    def feed(self, token):
+        self.token_sequence.append(int(token[0][0]))
+
+    def next(self):
+        allowed_tokens = self.token_enforcer.get_allowed_tokens(self.token_sequence)
+        # Newer exllamav2 versions accept sorted lists, which are cheaper to intersect than sets
+        if not hasattr(self, "allow_return_type_list"):
+            return set(allowed_tokens), set()
+        return sorted(allowed_tokens), []
+
+    def use_background_worker(self):
+        return True
+
+class GenerationRequest:
+    """A prompt waiting for or being decoded by the batching worker. Pieces are handed to the request's event loop."""
+
+    _END = object()
+
+    def __init__(
+        self, prompt: str, max_new_tokens: int, loop: asyncio.AbstractEventLoop, json_schema: dict | None = None
+    ):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.json_schema = json_schema
+        self.loop = loop
+        self.pieces = asyncio.Queue()
+        self.done = False
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+    def emit(self, item):
+        self.loop.call_soon_threadsafe(self.pieces.put_nowait, item)
+
+    def finish(self, error: Exception | None = None):
+        self.finished_at = time.perf_counter()
+        if error is not None:
+            self.emit(error)
+        self.emit(self._END)
+
+    async def stream(self):
+        while (item := await self.pieces.get()) is not self._END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        self.done = True
+
+    async def result(self) -> str:
+        return "".join([piece async for piece in self.stream()])
+
+
+class BatchingWorker:
+    """Owns the dynamic generator and decodes all concurrent requests together.
+
+    New requests join the running batch between two generator iterations, so concurrent prompts share the
+    forward passes instead of waiting for each other. The generator is only ever touched from the worker thread.
+    """
+
+    def __init__(self, generator: ExLlamaV2DynamicGenerator, latency_window: int = 1000):
+        self.generator = generator
+        self.incoming = queue.Queue()
+        self.cancelled = queue.Queue()
+        self.active: dict[ExLlamaV2DynamicJob, GenerationRequest] = {}
+        self.completed = 0
+        self.latencies = deque(maxlen = latency_window)
+        self.thread = threading.Thread(target = self.run, name = "exllama-worker", daemon = True)
+        self.thread.start()
+
+    def submit(self, request: GenerationRequest):
+        self.incoming.put(request)
+
+    def cancel(self, request: GenerationRequest):
+        self.cancelled.put(request)
+
+    def run(self):
+        while True:
+            # Block only while idle
+            if not self.active:
+                self.start(self.incoming.get())
+            while True:
+                try:
+                    self.start(self.incoming.get_nowait())
+                except queue.Empty:
+                    break
+            self.process_cancellations()
+            if not self.active:
+                continue
+
+            try:
+                results = self.generator.iterate()
+            except Exception as e:
+                print(f"Generator failed, aborting {len(self.active)} jobs: {e!r}")
+                for job, request in list(self.active.items()):
+                    self.generator.cancel(job)
+                    request.finish(e)
+                self.active.clear()
+                continue
+
+            for result in results:
+                request = self.active.get(result.get("job"))
+                if request is None:
+                    continue
+                text = result.get("text", "")
+                if text:
+                    if request.first_token_at is None:
+                        request.first_token_at = time.perf_counter()
+                    request.emit(text)
+                if result.get("eos"):
+                    del self.active[result["job"]]
+                    request.finish()
+                    self.record(request)
+
+    def start(self, request: GenerationRequest):
+        try:
+            input_ids = tokenizer.encode(request.prompt, add_bos = add_bos)
+            job = ExLlamaV2DynamicJob(
+                input_ids = input_ids,
+                max_new_tokens = request.max_new_tokens,
+                stop_conditions = stop_conditions,
+                seed = 15,
+                filters = [JsonSchemaFilter(request.json_schema)] if request.json_schema else None,
+                filter_prefer_eos = True,
+            )
+            self.generator.enqueue(job)
+        except Exception as e:
+            request.finish(e)
+            return
+        request.started_at = time.perf_counter()
+        self.active[job] = request
+
+    def process_cancellations(self):
+        while True:
+            try:
+                request = self.cancelled.get_nowait()
+            except queue.Empty:
+                return
+            for job, active_request in list(self.active.items()):
+                if active_request is request:
+                    self.generator.cancel(job)
+                    del self.active[job]
+                    request.finish()
+
+    def record(self, request: GenerationRequest):
+        self.completed += 1
+        self.latencies.append(
+            {
+                "queue_s": request.started_at - request.submitted_at,
+                "first_token_s": (request.first_token_at or request.finished_at) - request.submitted_at,
+                "total_s": request.finished_at - request.submitted_at,
+            }
+        )
+
+    def stats(self) -> dict:
+        summary = {}
+        for key in ("queue_s", "first_token_s", "total_s"):
+            values = sorted(latency[key] for latency in self.latencies)
+            if values:
+                summary[key] = {
+                    "mean": sum(values) / len(values),
+                    "p50": values[len(values) // 2],
+                    "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                }
+        return {
+            "queued": self.incoming.qsize(),
+            "active": len(self.active),
+            "completed": self.completed,
+            "latency": summary,
+        }
+
+
+worker = BatchingWorker(generator)
+
+async def stream_request(request: GenerationRequest):
+    """Yields newline-delimited JSON {"text": ...} pieces as the worker decodes them."""
+    try:
+        async for piece in request.stream():
+            yield json.dumps({"text": piece}) + "\n"
+    finally:
+        # The client disconnected before the job finished
+        if not request.done:
+            worker.cancel(request)
+
 app = FastAPI()
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/stats")
+def get_stats():
+    return JSONResponse(worker.stats())
+
 @app.post("/generate")
 async def generate(request: Request) -> Response:
     request_dict = await request.json()
     prompt = request_dict.pop("prompt")
     max_new_tokens = request_dict.pop("max_new_tokens")
-    response = generator.generate(prompt = prompt, max_new_tokens = max_new_tokens, add_bos = add_bos, stop_conditions=stop_conditions, completion_only=True, seed=15)
+    json_schema = request_dict.pop("json_schema", None)
+    generation_request = GenerationRequest(prompt, max_new_tokens, asyncio.get_running_loop(), json_schema)
+    worker.submit(generation_request)
+    if request_dict.pop("stream", False):
+        return StreamingResponse(stream_request(generation_request), media_type = "application/x-ndjson")
+    response = await generation_request.result()
     return JSONResponse(response)
 
 if __name__ == "__main__":
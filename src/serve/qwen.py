@@ -1,8 +1,14 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import FastAPI
 import uvicorn
+import asyncio
 import base64
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from io import BytesIO
 
 from PIL import Image
@@ -20,14 +26,23 @@ sys.path.append(project_root)
 
 # from settings.settings import settings
 
-from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 
 class StopOnCurlyBrace(StoppingCriteria):
     def __init__(self, tokenizer, stop_token="}"):
         self.stop_token_id = tokenizer.encode(stop_token, add_special_tokens=False)[-1]
 
     def __call__(self, input_ids, scores, **kwargs):
-        return input_ids[0][-1] == self.stop_token_id
+        # One flag per row so finished rows of a batch stop while the others keep generating
+        return input_ids[:, -1] == self.stop_token_id
+
+
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
 
 
 bnb_config = BitsAndBytesConfig(
@@ -38,9 +53,38 @@ model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
     "Qwen/Qwen2.5-VL-32B-Instruct", torch_dtype=torch.float16, device_map="auto", quantization_config=bnb_config,
 )
 processor = AutoProcessor.from_pretrained("Qwen/Qwen2.5-VL-32B-Instruct")
+# Batched generation needs the prompts right-aligned
+processor.tokenizer.padding_side = "left"
 
 stopping_criteria = StoppingCriteriaList([StopOnCurlyBrace(processor.tokenizer)])
 
+_token_enforcer_data = None
+
+
+def json_schema_generation_kwargs(json_schema: dict | None) -> dict:
+    """model.generate arguments that enforce json_schema on every row of the batch. Needs lm-format-enforcer."""
+    if json_schema is None:
+        # Without a schema, generation ends at the first closing brace
+        return {"stopping_criteria": stopping_criteria}
+
+    global _token_enforcer_data
+    from lmformatenforcer import JsonSchemaParser
+    from lmformatenforcer.integrations.transformers import (
+        build_token_enforcer_tokenizer_data,
+        build_transformers_prefix_allowed_tokens_fn,
+    )
+
+    # Walking the vocabulary is slow, so it happens once on the first constrained request
+    if _token_enforcer_data is None:
+        _token_enforcer_data = build_token_enforcer_tokenizer_data(processor.tokenizer)
+    # The closing brace of a nested object must not end generation, the enforcer only allows EOS once the JSON is done
+    return {
+        "stopping_criteria": StoppingCriteriaList(),
+        "prefix_allowed_tokens_fn": build_transformers_prefix_allowed_tokens_fn(
+            _token_enforcer_data, JsonSchemaParser(json_schema)
+        ),
+    }
+
 # import signal
 
 # class TimeoutException(Exception): pass
@@ -51,24 +95,153 @@ stopping_criteria = StoppingCriteriaList([StopOnCurlyBrace(processor.tokenizer)]
 # signal.signal(signal.SIGALRM, handler)
 # signal.alarm(300) 
     
-def format_prompt(prompt: str, image_input) -> list:
-    image_data = base64.b64decode(image_input)
-    image = Image.open(BytesIO(image_data)).convert("RGB")
-
-    return [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "image",
-                    "image": image,
-                },
-                {"type": "text", "text": prompt},
-            ],
-        }
+def format_prompt(prompt: str, image_input: str | None = None, system_prompt: str | None = None) -> list:
+    content = []
+    if image_input:
+        image_data = base64.b64decode(image_input)
+        image = Image.open(BytesIO(image_data)).convert("RGB")
+        content.append(
+            {
+                "type": "image",
+                "image": image,
+            }
+        )
+    content.append({"type": "text", "text": prompt})
+
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": [{"type": "text", "text": system_prompt}]})
+    messages.append({"role": "user", "content": content})
+    return messages
+
+
+def prepare_inputs(prompt: str, image_input: str | None = None, system_prompt: str | None = None):
+    return prepare_batch_inputs([format_prompt(prompt, image_input, system_prompt)])
+
+
+def prepare_batch_inputs(batch_messages: list[list]):
+    texts = [
+        processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        for messages in batch_messages
     ]
+    image_inputs, _ = process_vision_info(batch_messages)
+    inputs = processor(
+        text=texts,
+        images=image_inputs,
+        #videos=video_inputs,
+        padding=True,
+        return_tensors="pt",
+    )
+    return inputs.to("cuda")
+
+
+# Requests arriving within MAX_BATCH_WAIT_MS of each other are decoded as one padded batch
+MAX_BATCH_SIZE = int(os.environ.get("QWEN_MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get("QWEN_MAX_BATCH_WAIT_MS", 50))
+
+# model.generate calls from the batcher and from streaming requests must not share the GPU
+gpu_lock = threading.Lock()
+
+
+def generate_stream(inputs, max_new_tokens: int, json_schema: dict | None = None):
+    """Yields newline-delimited JSON {"text": ...} pieces while model.generate runs in a background thread."""
+    streamer = TextIteratorStreamer(
+        processor.tokenizer, skip_prompt=True, skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
+    stop_event = threading.Event()
+    generation_kwargs = json_schema_generation_kwargs(json_schema)
+    generation_kwargs["stopping_criteria"] = StoppingCriteriaList(
+        [*generation_kwargs["stopping_criteria"], StopOnEvent(stop_event)]
+    )
 
+    def run():
+        with gpu_lock:
+            model.generate(**inputs, max_new_tokens=max_new_tokens, streamer=streamer, **generation_kwargs)
 
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        for text in streamer:
+            if text:
+                yield json.dumps({"text": text}) + "\n"
+    finally:
+        # Stops the generation if the client disconnected early
+        stop_event.set()
+        thread.join()
+
+
+class BatchRequest:
+    def __init__(self, messages: list, max_new_tokens: int, json_schema: dict | None = None):
+        self.messages = messages
+        self.max_new_tokens = max_new_tokens
+        self.json_schema = json_schema
+        self.future = Future()
+
+
+class MicroBatcher:
+    """Collects /generate requests for up to max_wait_ms and runs them through model.generate as one batch."""
+
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_BATCH_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="qwen-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, messages: list, max_new_tokens: int, json_schema: dict | None = None) -> Future:
+        request = BatchRequest(messages, max_new_tokens, json_schema)
+        self.requests.put(request)
+        return request.future
+
+    def collect(self) -> list[BatchRequest]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            # Rows of one model.generate call share the decoding constraints, so each schema gets its own batch
+            groups = {}
+            for request in self.collect():
+                groups.setdefault(json.dumps(request.json_schema, sort_keys=True), []).append(request)
+            for batch in groups.values():
+                try:
+                    outputs = self.generate(batch)
+                except Exception as e:
+                    print(f"Batch of {len(batch)} failed: {e!r}")
+                    for request in batch:
+                        request.future.set_exception(e)
+                    continue
+                for request, output in zip(batch, outputs):
+                    request.future.set_result(output)
+
+    def generate(self, batch: list[BatchRequest]) -> list[str]:
+        inputs = prepare_batch_inputs([request.messages for request in batch])
+        with gpu_lock:
+            generated_ids = model.generate(
+                **inputs,
+                max_new_tokens=max(request.max_new_tokens for request in batch),
+                **json_schema_generation_kwargs(batch[0].json_schema),
+            )
+        # Prompts are left padded, so the generated tokens of every row start at the same offset
+        generated_ids = generated_ids[:, inputs.input_ids.shape[1] :]
+        print(f"Generated batch of {len(batch)}")
+        return processor.batch_decode(
+            [ids[: request.max_new_tokens] for ids, request in zip(generated_ids, batch)],
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        )
+
+
+batcher = MicroBatcher()
 
 app = FastAPI()
 @app.get("/")
@@ -79,43 +252,21 @@ def read_root():
 async def generate(request: Request) -> Response:
     request_dict = await request.json()
     prompt = request_dict.pop("prompt")
-    image_input = request_dict.pop("image_input")
+    image_input = request_dict.pop("image_input", None)
+    system_prompt = request_dict.pop("system_prompt", None)
     max_new_tokens = request_dict.pop("max_new_tokens")
-    
-    
-    formatted_messages = format_prompt(prompt, image_input)
-    
-    text = processor.apply_chat_template(
-        formatted_messages, tokenize=False, add_generation_prompt=True
-    )
-    image_inputs, _ = process_vision_info(formatted_messages)
-    inputs = processor(
-        text=[text],
-        images=image_inputs,
-        #videos=video_inputs,
-        padding=True,
-        return_tensors="pt",
-    )
-    inputs = inputs.to("cuda")
-    
-    # try:
-    generated_ids = model.generate(
-        **inputs, 
-        max_new_tokens=max_new_tokens, 
-        stopping_criteria=stopping_criteria
-    )
-    # except TimeoutException:
-    #     print("Generation took too long.")
-    #     return JSONResponse({"error": "Timeout during generation"}, status_code=500)
-    # finally:
-    #     signal.alarm(0)
-    generated_ids_trimmed = [
-        out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = processor.batch_decode(
-        generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-    )
-    return JSONResponse(output_text)
+    json_schema = request_dict.pop("json_schema", None)
+
+    if request_dict.pop("stream", False):
+        inputs = prepare_inputs(prompt, image_input, system_prompt)
+        return StreamingResponse(
+            generate_stream(inputs, max_new_tokens, json_schema), media_type="application/x-ndjson"
+        )
+
+    messages = format_prompt(prompt, image_input, system_prompt)
+    output_text = await asyncio.wrap_future(batcher.submit(messages, max_new_tokens, json_schema))
+    # Keeps the single-element list format clients already parse
+    return JSONResponse([output_text])
 
 if __name__ == "__main__":
     port_number = 8082
@@ -0,0 +1,219 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from settings.settings import config
+
+# Matches ConversationState.GENERATING, kept here to avoid importing the service
+_GENERATING = 0
+
+
+class ConversationStore(ABC):
+    """
+    Storage of the chat conversations, which are plain JSON-serializable dicts with "id" and "state" keys.
+
+    Ids are allocated by the store so that several server processes sharing one store never hand out the same id.
+    """
+
+    @abstractmethod
+    def allocate_id(self, name: str) -> int:
+        """Returns the next value of the named counter, e.g. "conversation" or "detail"."""
+
+    @abstractmethod
+    def get(self, id: str) -> dict | None: ...
+
+    @abstractmethod
+    def put(self, id: str, conversation: dict): ...
+
+    @abstractmethod
+    def touch(self, id: str):
+        """Marks a conversation as alive while it is being generated."""
+
+    @abstractmethod
+    def claim_stale(self, stale_after: float) -> list[dict]:
+        """Returns generating conversations that were not touched for stale_after seconds and marks them alive.
+
+        A claimed conversation is not returned again to any process until it goes stale once more, so the
+        generation of a crashed process is resumed exactly once.
+        """
+
+    @abstractmethod
+    def __len__(self) -> int: ...
+
+
+class MemoryConversationStore(ConversationStore):
+    """Keeps conversations in process memory, bounded by max_entries (least recently used first) and a TTL."""
+
+    def __init__(self, max_entries: int = 10_000, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conversations: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._counters: dict[str, int] = {}
+
+    def allocate_id(self, name: str) -> int:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+    def get(self, id: str) -> dict | None:
+        with self._lock:
+            if id not in self._conversations:
+                return None
+            conversation, updated = self._conversations[id]
+            if self.ttl is not None and time.time() - updated > self.ttl:
+                del self._conversations[id]
+                return None
+            self._conversations.move_to_end(id)
+            return conversation
+
+    def put(self, id: str, conversation: dict):
+        with self._lock:
+            self._conversations[id] = (conversation, time.time())
+            self._conversations.move_to_end(id)
+            self._evict()
+
+    def touch(self, id: str):
+        with self._lock:
+            if id in self._conversations:
+                self._conversations[id] = (self._conversations[id][0], time.time())
+
+    def claim_stale(self, stale_after: float) -> list[dict]:
+        now = time.time()
+        claimed = []
+        with self._lock:
+            for id, (conversation, updated) in list(self._conversations.items()):
+                if conversation["state"] == _GENERATING and now - updated > stale_after:
+                    self._conversations[id] = (conversation, now)
+                    claimed.append(conversation)
+        return claimed
+
+    def _evict(self):
+        if self.ttl is not None:
+            cutoff = time.time() - self.ttl
+            for id in [id for id, (_, updated) in self._conversations.items() if updated < cutoff]:
+                del self._conversations[id]
+        while len(self._conversations) > self.max_entries:
+            self._conversations.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._conversations)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Keeps conversations in a SQLite file that survives restarts and can be shared by several server processes."""
+
+    def __init__(self, path: str, max_entries: int = 10_000, ttl: float | None = None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Transactions are managed explicitly so id allocation and claiming can lock the database
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                state INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def allocate_id(self, name: str) -> int:
+        with self._lock:
+            (value,) = self._connection.execute(
+                """
+                INSERT INTO counters VALUES (?, 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + 1
+                RETURNING value
+                """,
+                (name,),
+            ).fetchone()
+        return value
+
+    def get(self, id: str) -> dict | None:
+        with self._lock:
+            row = self._connection.execute("SELECT data, updated FROM conversations WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        data, updated = row
+        if self.ttl is not None and time.time() - updated > self.ttl:
+            return None
+        return json.loads(data)
+
+    def put(self, id: str, conversation: dict):
+        data = json.dumps(conversation, ensure_ascii=False)
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                    (id, conversation["state"], data, time.time()),
+                )
+                self._evict()
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def touch(self, id: str):
+        with self._lock:
+            self._connection.execute("UPDATE conversations SET updated = ? WHERE id = ?", (time.time(), id))
+
+    def claim_stale(self, stale_after: float) -> list[dict]:
+        now = time.time()
+        with self._lock:
+            # The write lock makes the select and update atomic across processes
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT id, data FROM conversations WHERE state = ? AND updated < ?",
+                    (_GENERATING, now - stale_after),
+                ).fetchall()
+                self._connection.executemany(
+                    "UPDATE conversations SET updated = ? WHERE id = ?", [(now, id) for id, _ in rows]
+                )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return [json.loads(data) for _, data in rows]
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._connection.execute("DELETE FROM conversations WHERE updated < ?", (time.time() - self.ttl,))
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM conversations").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM conversations WHERE id IN (SELECT id FROM conversations ORDER BY updated ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM conversations").fetchone()
+        return count
+
+
+def get_conversation_store() -> ConversationStore:
+    if config.conversation_store == "memory":
+        return MemoryConversationStore(config.conversation_max_entries, config.conversation_ttl)
+    elif config.conversation_store == "sqlite":
+        if not config.conversation_store_path:
+            raise ValueError("conversation_store_path_raw must be set for the sqlite conversation store")
+        return SQLiteConversationStore(
+            config.conversation_store_path, config.conversation_max_entries, config.conversation_ttl
+        )
+    else:
+        raise ValueError(f"Invalid conversation store: {config.conversation_store}")
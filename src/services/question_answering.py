@@ -1,10 +1,22 @@
-from typing import NamedTuple
+from typing import AsyncIterator, Iterator, NamedTuple
 from enum import Enum
-
-from core.generation import create_question_prompt_w_docs_prod
-from parsing import parse_with_retry, Answer, FollowUpQuestion, ThinkingAnswer, ReasoningAnswer
+import asyncio
+import copy
+import json
+
+from core.generation import create_question_prompt_w_docs_prod, get_answer_model
+from parsing import (
+    parse_with_retry,
+    parse_stream,
+    IncrementalJsonParser,
+    Answer,
+    FollowUpQuestion,
+    ThinkingAnswer,
+    ReasoningAnswer,
+)
 from services.retrieval import FaissService, _retrieve
-from core.model import generate_response
+from services.conversation_store import ConversationStore, get_conversation_store
+from core.model import generate_response, generate_response_stream, clean_response
 from domain.document import Chunk
 from settings import config
 
@@ -15,12 +27,9 @@ class RAGAnswer(NamedTuple):
     reasoning: str | None = None
 
 
-def generate_rag_answer(
-    question: str,
-    faiss_service: FaissService,
-    augmented_question: str | None = None,
-    follow_flowchart_page: int | None = None,
-) -> RAGAnswer:
+def _retrieve_for_answer(
+    question: str, faiss_service: FaissService, follow_flowchart_page: int | None = None
+) -> list[Chunk]:
     if follow_flowchart_page is not None:
         print(f"Following the flowchart on page {follow_flowchart_page}")
         from eval.generation_metrics import get_generated_flowchart_page_description
@@ -35,31 +44,97 @@ def generate_rag_answer(
             )
         )
     else:
-        retrieved_documents: list[Chunk] = _retrieve(question, faiss_service)
+        retrieved_documents: list[Chunk] = _retrieve(question, faiss_service, use_cache=True)
+    return retrieved_documents
+
+
+def _split_rag_answer(parsed_answer: Answer | ReasoningAnswer | ThinkingAnswer) -> tuple[str, str | None]:
+    if isinstance(parsed_answer, ThinkingAnswer):
+        return parsed_answer.answer, parsed_answer.thinking
+    elif isinstance(parsed_answer, ReasoningAnswer):
+        return parsed_answer.answer, parsed_answer.reasoning
+    else:
+        return parsed_answer.answer, None
+
+
+def _parse_rag_answer(generated_answer: str) -> tuple[str, str | None]:
+    return _split_rag_answer(parse_with_retry(get_answer_model(), generated_answer))
+
+
+def generate_rag_answer(
+    question: str,
+    faiss_service: FaissService,
+    augmented_question: str | None = None,
+    follow_flowchart_page: int | None = None,
+) -> RAGAnswer:
+    retrieved_documents = _retrieve_for_answer(question, faiss_service, follow_flowchart_page)
 
     references = {retrieved_doc.start_page: retrieved_doc.type for retrieved_doc in retrieved_documents}
 
     system_prompt, user_prompt = create_question_prompt_w_docs_prod(retrieved_documents, augmented_question)
-    generated_answer = generate_response(user_prompt, system_prompt)
-
-    reasoning = None
-    if config.thinking:
-        generated_answer = parse_with_retry(ThinkingAnswer, generated_answer)
-        reasoning = generated_answer.thinking
-        generated_answer = generated_answer.answer
-    elif config.reasoning:
-        generated_answer = parse_with_retry(ReasoningAnswer, generated_answer)
-        reasoning = generated_answer.reasoning
-        generated_answer = generated_answer.answer
-    else:
-        generated_answer = parse_with_retry(Answer, generated_answer)
-        generated_answer = generated_answer.answer
+    generated_answer = generate_response(user_prompt, system_prompt, response_model=get_answer_model())
 
+    generated_answer, reasoning = _parse_rag_answer(generated_answer)
     return RAGAnswer(generated_answer, references, reasoning)
 
 
+def stream_rag_answer(
+    question: str,
+    faiss_service: FaissService,
+    augmented_question: str | None = None,
+    follow_flowchart_page: int | None = None,
+) -> Iterator[dict]:
+    """Streaming variant of generate_rag_answer.
+
+    Yields a "references" event once retrieval is done, "delta" events with the raw model output as it is decoded,
+    a "field" event for each top-level field of the JSON answer as soon as it is complete, and a final "answer"
+    event with the parsed answer and reasoning.
+    """
+    retrieved_documents = _retrieve_for_answer(question, faiss_service, follow_flowchart_page)
+
+    references = {retrieved_doc.start_page: retrieved_doc.type for retrieved_doc in retrieved_documents}
+    yield {"type": "references", "pages": list(references)}
+
+    system_prompt, user_prompt = create_question_prompt_w_docs_prod(retrieved_documents, augmented_question)
+    answer_model = get_answer_model()
+    parser = IncrementalJsonParser(answer_model)
+    pieces = generate_response_stream(user_prompt, system_prompt, response_model=answer_model)
+    try:
+        for piece in pieces:
+            yield {"type": "delta", "text": piece}
+            # Lets the client show the answer while the remaining fields, e.g. the thinking, are still generated
+            for name, value in parser.feed(piece):
+                yield {"type": "field", "name": name, "value": value}
+            if parser.done:
+                break
+    finally:
+        # Stops the generation once the JSON object is closed
+        pieces.close()
+
+    parsed_answer = parser.result()
+    if parsed_answer is not None:
+        generated_answer, reasoning = _split_rag_answer(parsed_answer)
+    else:
+        generated_answer, reasoning = _parse_rag_answer(clean_response(parser.text))
+    yield {"type": "answer", "answer": generated_answer, "reasoning": reasoning, "pages": list(references)}
+
+
+def _generate_followup_question(user_prompt: str, system_prompt: str) -> FollowUpQuestion | None:
+    pieces = generate_response_stream(user_prompt, system_prompt, response_model=FollowUpQuestion)
+    events = parse_stream(FollowUpQuestion, pieces)
+    try:
+        for name, value in events:
+            # No need to wait for a question and options that are not needed
+            if name == "follow_up_required" and not value:
+                return None
+            if name == "result":
+                return value if value.follow_up_required else None
+    finally:
+        events.close()
+
+
 def generate_followup_questions_if_needed(question: str, faiss_service: FaissService) -> FollowUpQuestion | None:
-    retrieved_documents: list[Chunk] = _retrieve(question, faiss_service)
+    retrieved_documents: list[Chunk] = _retrieve(question, faiss_service, use_cache=True)
 
     system_prompt = """
         You are a medical assistant specialized in supporting clinicians during decision making.
@@ -89,13 +164,7 @@ def generate_followup_questions_if_needed(question: str, faiss_service: FaissSer
     """
 
     _, user_prompt = create_question_prompt_w_docs_prod(retrieved_documents, question)
-    response = generate_response(user_prompt, system_prompt)
-
-    followup_question: FollowUpQuestion = parse_with_retry(FollowUpQuestion, response)
-    if followup_question.follow_up_required:
-        return followup_question
-    else:
-        None
+    return _generate_followup_question(user_prompt, system_prompt)
 
 
 def generate_followup_questions_following_the_flowchart(
@@ -143,13 +212,7 @@ def generate_followup_questions_following_the_flowchart(
     """
 
     _, user_prompt = create_question_prompt_w_docs_prod(retrieved_documents, question)
-    response = generate_response(user_prompt, system_prompt)
-
-    followup_question: FollowUpQuestion = parse_with_retry(FollowUpQuestion, response)
-    if followup_question.follow_up_required:
-        return followup_question
-    else:
-        None
+    return _generate_followup_question(user_prompt, system_prompt)
 
 
 class ConversationState(Enum):
@@ -178,15 +241,44 @@ class Conversation:
         }
 
 
+async def _iterate_in_thread(iterator: Iterator) -> AsyncIterator:
+    """Advances a blocking iterator in worker threads so the event loop stays free between items."""
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+
+class ConversationBusyError(RuntimeError):
+    """Raised when a conversation is changed while another worker is generating it."""
+
+
 class ConversationService:
-    last_conversation_id = 0
-    last_detail_id = 0
-    conversations = dict()
+    """
+    Keeps the conversations of the chat frontend.
+
+    Retrieval and generation run as background tasks with the blocking parts in worker threads, so requests return
+    right away and a slow question does not hold up other users. Conversations are only modified on the event loop.
+
+    Conversations live in a ConversationStore. Those generated by this process are also kept in _active and written
+    to the store on every change. While generating, a conversation is touched every HEARTBEAT seconds, so a sqlite
+    store shared by several workers lets resume_interrupted pick up conversations of a crashed or restarted worker.
+    """
+
+    HEARTBEAT = 10.0
+    POLL_INTERVAL = 1.0
     document_index: FaissService
 
+    def __init__(self, store: ConversationStore | None = None):
+        self.store = store or get_conversation_store()
+        self._active: dict[str, dict] = {}
+        # The generation task of each conversation in _active
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._changed: dict[str, asyncio.Event] = {}
+        # Store writes run in worker threads, the lock keeps them in order so the last change is the one stored
+        self._store_lock = asyncio.Lock()
+
     async def create_conversation(self, question: str, previous_question: str) -> tuple[str, str | None]:
-        self.last_conversation_id += 1
-        id = self.last_conversation_id
+        id = await asyncio.to_thread(self.store.allocate_id, "conversation")
 
         quick_answer = {
             "type": "quick",
@@ -203,71 +295,150 @@ class ConversationService:
             answers=[quick_answer],
         )
         conversation = conversation.to_dict()
-        self.conversations[str(id)] = conversation
-
-        def on_update(
-            generated_answer: str | None,
-            references: dict | None,
-            form_detail: dict = None,
-            reasoning: str | None = None,
-        ):
-            if generated_answer:
-                quick_answer["text"] = generated_answer
-            if references:
-                quick_answer["references"] = [
-                    {"type": "pdf", "document": "handbuch.pdf", "page": page} for page, chunk_type in references.items()
-                ]
-            if form_detail:
-                conversation["details"] = [form_detail]
-
-            if not generated_answer and not form_detail:
-                generated_answer = "Sorry there has been a problem with your request."
-                quick_answer["text"] = generated_answer
-
-            if reasoning:
-                quick_answer["reasoning"] = reasoning
+        self._active[str(id)] = conversation
 
         print(f"Creating conversation with ID {id} and question: {question}")
-        if config.following_flowchart:
-            print("Following the flowchart")
-            followup_question = generate_followup_questions_following_the_flowchart(question, self.document_index)
-        else:
-            followup_question = generate_followup_questions_if_needed(question, self.document_index)
-
-        if followup_question is not None:
-            self.last_detail_id += 1
-            form_detail = {
-                "id": self.last_detail_id,  # Ideally make this dynamic later
-                "type": "form",
-                "template": {
-                    "text": followup_question.follow_up_question,
-                    "fields": {"art": {"type": "select", "label": "Select", "options": followup_question.options}},
-                },
-            }
-            on_update(None, None, form_detail, None)
-        else:
-            # No follow-up needed → generate final answer immediately
-
-            generated_answer, references, reasoning = generate_rag_answer(
-                question, self.document_index, question, config.flowchart_page
-            )
-
-            on_update(generated_answer, references, None, reasoning)
+        self._start_task(str(id), self._generate_first_answer(str(id), question))
+        await self._save(str(id))
+        return id, None
 
-        if conversation["details"]:
-            conversation["state"] = ConversationState.WAITING_FOR_USER.value
-        else:
+    def _start_task(self, conversation_id: str, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(self._run(conversation_id, coroutine))
+        # The event loop only keeps weak references to tasks
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+        return task
+
+    async def _run(self, conversation_id: str, coroutine):
+        heartbeat = asyncio.create_task(self._heartbeat(conversation_id))
+        try:
+            await coroutine
+        finally:
+            heartbeat.cancel()
+            await self._save(conversation_id)
+            self._active.pop(conversation_id, None)
+
+    async def _heartbeat(self, conversation_id: str):
+        while True:
+            await asyncio.sleep(self.HEARTBEAT)
+            await asyncio.to_thread(self.store.touch, conversation_id)
+
+    async def _save(self, conversation_id: str):
+        # Copied on the loop, the generation task keeps changing the conversation while the thread writes it
+        conversation = copy.deepcopy(self._active[conversation_id])
+        async with self._store_lock:
+            await asyncio.to_thread(self.store.put, conversation_id, conversation)
+        if event := self._changed.pop(conversation_id, None):
+            event.set()
+
+    async def resume_interrupted(self):
+        """Restarts the generation of conversations whose worker stopped touching them, runs until cancelled."""
+        while True:
+            for conversation in await asyncio.to_thread(self.store.claim_stale, 3 * self.HEARTBEAT):
+                conversation_id = str(conversation["id"])
+                if conversation_id in self._active:
+                    continue
+                print(f"Resuming interrupted conversation {conversation_id}")
+                self._active[conversation_id] = conversation
+                question = conversation["text"]
+                if any("selected_value" in detail.get("template", {}) for detail in conversation["details"]):
+                    augmented_question = self.augment_question_with_details(question, conversation["details"])
+                    self._start_task(
+                        conversation_id, self._update_answer(conversation_id, question, augmented_question)
+                    )
+                else:
+                    self._start_task(conversation_id, self._generate_first_answer(conversation_id, question))
+            await asyncio.sleep(self.HEARTBEAT)
+
+    async def _generate_first_answer(self, conversation_id: str, question: str):
+        conversation = self._active[conversation_id]
+        try:
+            if config.following_flowchart:
+                print("Following the flowchart")
+                followup_question = await asyncio.to_thread(
+                    generate_followup_questions_following_the_flowchart, question, self.document_index
+                )
+            else:
+                followup_question = await asyncio.to_thread(
+                    generate_followup_questions_if_needed, question, self.document_index
+                )
+
+            if followup_question is not None:
+                form_detail = {
+                    "id": await asyncio.to_thread(self.store.allocate_id, "detail"),  # Ideally make this dynamic later
+                    "type": "form",
+                    "template": {
+                        "text": followup_question.follow_up_question,
+                        "fields": {
+                            "art": {"type": "select", "label": "Select", "options": followup_question.options}
+                        },
+                    },
+                }
+                conversation["details"] = [form_detail]
+                conversation["state"] = ConversationState.WAITING_FOR_USER.value
+            else:
+                # No follow-up needed → generate final answer immediately
+                await self._stream_answer(conversation_id, question, question)
+        except Exception as e:
+            print(f"Generation for conversation {conversation_id} failed: {e!r}")
+            conversation["answers"][0]["text"] = "Sorry there has been a problem with your request."
             conversation["state"] = ConversationState.FINISHED.value
-        return id, None
+
+    async def _stream_answer(self, conversation_id: str, question: str, augmented_question: str):
+        """Generates the answer of a conversation, updating it as references and answer fields arrive."""
+        conversation = self._active[conversation_id]
+        quick_answer = conversation["answers"][0]
+        events = stream_rag_answer(question, self.document_index, augmented_question, config.flowchart_page)
+        async for event in _iterate_in_thread(events):
+            if event["type"] == "references":
+                quick_answer["references"] = [
+                    {"type": "pdf", "document": "handbuch.pdf", "page": page} for page in event["pages"]
+                ]
+            elif event["type"] == "field" and event["name"] == "answer":
+                quick_answer["text"] = event["value"]
+            elif event["type"] == "field" and event["name"] in ("thinking", "reasoning"):
+                quick_answer["reasoning"] = event["value"]
+            elif event["type"] == "answer":
+                quick_answer["text"] = event["answer"] or "Sorry there has been a problem with your request."
+                if event["reasoning"]:
+                    quick_answer["reasoning"] = event["reasoning"]
+            else:
+                continue
+            await self._save(conversation_id)
+        conversation["state"] = ConversationState.FINISHED.value
 
     def get_conversation(self, id: str) -> dict | None:
-        if id in self.conversations:
-            return self.conversations[id]
+        if id in self._active:
+            return self._active[id]
         else:
-            return None
-
-    def update_conversation_detail(self, conversation_id: str, detail_id: str, value: any) -> dict | None:
+            return self.store.get(id)
+    async def watch_conversation(self, id: str) -> AsyncIterator[dict]:
+        """Yields the conversation now and after every change until it stops generating."""
+        last_snapshot = None
+        while (conversation := self.get_conversation(id)) is not None:
+            # Taken before yielding so changes made while the caller sends this snapshot are not missed
+            changed = self._changed.setdefault(id, asyncio.Event())
+            snapshot = json.dumps(conversation, sort_keys=True)
+            if snapshot != last_snapshot:
+                last_snapshot = snapshot
+                yield conversation
+            if conversation["state"] != ConversationState.GENERATING.value:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), self.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                # Another worker may be generating it, which is only visible through the store
+                pass
+
+    async def update_conversation_detail(self, conversation_id: str, detail_id: str, value: any) -> dict | None:
+        # A second answer to the form waits for the generation of the first instead of running alongside it
+        while (running := self._tasks.get(conversation_id)) is not None:
+            await asyncio.wait({running})
         conversation = self.get_conversation(conversation_id)
+        if conversation is None:
+            return None
+        if conversation["state"] == ConversationState.GENERATING.value:
+            raise ConversationBusyError(f"Conversation {conversation_id} is being generated by another worker")
         for detail in conversation["details"]:
             if "template" in detail:
                 if detail["id"] == int(detail_id):
@@ -277,23 +448,27 @@ class ConversationService:
 
         original_question = conversation["text"]
         augmented_question = self.augment_question_with_details(original_question, conversation["details"])
-        generated_answer, references, reasoning = generate_rag_answer(
-            original_question, self.document_index, augmented_question, config.flowchart_page
+        conversation["state"] = ConversationState.GENERATING.value
+        self._active[conversation_id] = conversation
+        # Started before the first await so a concurrent update of the same conversation finds the task
+        task = self._start_task(
+            conversation_id, self._update_answer(conversation_id, original_question, augmented_question)
         )
-
-        if generated_answer:
-            print("will update answer text")
-            conversation["answers"][0]["text"] = generated_answer
-        if references:
-            conversation["answers"][0]["references"] = [
-                {"type": "pdf", "document": "handbuch.pdf", "page": page} for page, chunk_type in references.items()
-            ]
-        if reasoning:
-            conversation["answers"][0]["reasoning"] = reasoning
-
-        conversation["state"] = ConversationState.FINISHED.value
+        await self._save(conversation_id)
+        # Awaited so the response still carries the answer, the event loop keeps serving other requests meanwhile.
+        # Shielded so a client that disconnects does not cancel the generation, the conversation is still finished.
+        await asyncio.shield(task)
         return conversation
 
+    async def _update_answer(self, conversation_id: str, original_question: str, augmented_question: str):
+        conversation = self._active[conversation_id]
+        try:
+            await self._stream_answer(conversation_id, original_question, augmented_question)
+        except Exception as e:
+            print(f"Generation for conversation {conversation_id} failed: {e!r}")
+            conversation["answers"][0]["text"] = "Sorry there has been a problem with your request."
+            conversation["state"] = ConversationState.FINISHED.value
+
     def augment_question_with_details(self, original_question: str, details: list) -> str:
         """
         Insert details into the original question text to enrich it.
@@ -317,6 +492,3 @@ class ConversationService:
         else:
             print("No details to augment the question: {detail_texts}")
             return original_question
-
-    def to_json(self):
-        return {"last_conversation_id": self.last_conversation_id, "conversations": self.conversations}
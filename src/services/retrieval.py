@@ -2,17 +2,20 @@ import faiss
 from typing import Callable
 import os
 import base64
-import requests
+import hashlib
 import json
+import shutil
+import time
 import numpy as np
 from collections import defaultdict
 
-from core.embedding import embed_chunks
+from core.embedding import embed_chunks, EMBEDDING_MODEL
+from services.retrieval_cache import get_retrieval_cache
 from settings.settings import config, settings
-from core.utils import replace_abbreviations
+from core.utils import replace_abbreviations, replace_abbreviations_batch
 from domain.vignette import Vignette, Question
 from domain.document import Chunk, ChunkType, Document
-from core.model import generate_response
+from core.model import generate_response, get_json_schema, get_llm_client
 from core.generation import create_user_question_prompt
 from prompts import (
     HYPOTHETICAL_DOCUMENT_PROMPT,
@@ -27,11 +30,101 @@ from parsing import parse_with_retry, TableDescription, FlowchartDescription
 from langchain_core.output_parsers import BaseOutputParser
 
 
+SNAPSHOT_VERSION = 1
+SNAPSHOT_META_FILE = "meta.json"
+SNAPSHOT_INDEX_FILE = "index.faiss"
+SNAPSHOT_CHUNKS_FILE = "chunks.json"
+
+
+def compute_chunks_hash(retrieval_strings: list[str], chunks: list[Chunk], model: str = EMBEDDING_MODEL) -> str:
+    """Content hash of the indexed chunks and the embedding model, used to version index snapshots."""
+    # chunk.index is assigned by set_chunk_indices, so it is not part of the content
+    payload = json.dumps(
+        {
+            "model": model,
+            "chunks": [
+                (text, {key: value for key, value in chunk.to_dict().items() if key != "index"})
+                for text, chunk in zip(retrieval_strings, chunks)
+            ],
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def get_index_spec(index_type: str | None = None) -> dict:
+    """Build parameters of the configured index type. Search-time parameters (nprobe, efSearch) are not included."""
+    index_type = index_type or config.index_type
+    if index_type == "flat":
+        return {"index_type": index_type}
+    elif index_type == "hnsw":
+        return {"index_type": index_type, "m": config.hnsw_m, "ef_construction": config.hnsw_ef_construction}
+    elif index_type == "ivf_flat":
+        return {"index_type": index_type, "nlist": config.ivf_nlist}
+    elif index_type == "ivf_pq":
+        return {"index_type": index_type, "nlist": config.ivf_nlist, "pq_m": config.pq_m, "pq_nbits": config.pq_nbits}
+    else:
+        raise ValueError(f"Invalid index type: {index_type}")
+
+
+def create_faiss_index(embeddings: np.ndarray, index_type: str | None = None) -> faiss.Index:
+    """Creates an inner product index of the given type, trains it on `embeddings` if required and adds them.
+
+    Args:
+        embeddings (np.ndarray): (n, d) float32 embeddings to index.
+        index_type (str | None, optional): flat, hnsw, ivf_flat or ivf_pq. Defaults to config.index_type.
+
+    Returns:
+        faiss.Index: The populated index with search parameters applied.
+    """
+    spec = get_index_spec(index_type)
+    n, d = embeddings.shape
+
+    if spec["index_type"] == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif spec["index_type"] == "hnsw":
+        index = faiss.IndexHNSWFlat(d, spec["m"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = spec["ef_construction"]
+    else:
+        # k-means needs at least as many training points as clusters
+        nlist = min(spec["nlist"], n)
+        if nlist < spec["nlist"]:
+            print(f"Reducing nlist from {spec['nlist']} to {nlist} for {n} embeddings")
+        quantizer = faiss.IndexFlatIP(d)
+        if spec["index_type"] == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            if d % spec["pq_m"] != 0:
+                raise ValueError(f"pq_m ({spec['pq_m']}) must divide the embedding dimension ({d})")
+            pq_nbits = min(spec["pq_nbits"], int(np.log2(n)))
+            if pq_nbits < spec["pq_nbits"]:
+                print(f"Reducing pq_nbits from {spec['pq_nbits']} to {pq_nbits} for {n} embeddings")
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, spec["pq_m"], pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+
+    index.add(embeddings)
+    set_search_params(index)
+    return index
+
+
+def set_search_params(index: faiss.Index):
+    """Applies the configured search-time parameters, so they can change without rebuilding the index."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.hnsw_ef_search
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = config.ivf_nprobe
+
+
 class FaissService:
     def __init__(self):
         self.index = None
         self.chunks: list[Chunk] = None
         self.retrieval_strings: list[str] = None
+        self.version: str | None = None
+        self.snapshot_path: str | None = None
+        self.section_ids: np.ndarray | None = None
+        self.mergeable: np.ndarray | None = None
 
     def create_index(
         self,
@@ -39,7 +132,15 @@ class FaissService:
         retrieve_by: Callable[[Chunk], str] = lambda chunk: chunk.section_heading + " " + chunk.text
         if chunk.section_heading
         else chunk.text,
+        snapshot_dir: str | None = config.index_snapshot_dir,
     ):
+        """Builds the index, or loads it from `snapshot_dir` if a snapshot for the same chunks and model exists.
+
+        Args:
+            chunks (list[Chunk] | list[tuple[str, Chunk]]): Chunks or (retrieval string, chunk) tuples to index.
+            retrieve_by (Callable[[Chunk], str], optional): Builds the retrieval string, ignored for tuple input.
+            snapshot_dir (str | None, optional): Directory for versioned snapshots. Defaults to config.index_snapshot_dir.
+        """
         if chunks is None:
             raise ValueError("Image representations cannot be None")
 
@@ -52,99 +153,271 @@ class FaissService:
         else:
             raise ValueError("Invalid input type for chunks")
 
+        self.version = compute_chunks_hash(self.retrieval_strings, chunks)
+        snapshot_path = None
+        if snapshot_dir:
+            # The same embeddings can back several index types, each gets its own snapshot
+            index_spec = "_".join(str(value) for value in get_index_spec().values())
+            snapshot_path = os.path.join(snapshot_dir, f"{self.version}_{index_spec}")
+        if snapshot_path and os.path.exists(os.path.join(snapshot_path, SNAPSHOT_META_FILE)):
+            self.load_snapshot(snapshot_path)
+            return
+
         embeddings = embed_chunks(
             self.retrieval_strings,
             task_type="search_document",
-        )
+        ).astype(np.float32)
 
-        d = embeddings.shape[1]
-        index = faiss.IndexFlatIP(d)  # TODO: parametrize
-        index.add(embeddings)
-        print("Index created with {} chunks".format(index.ntotal))
+        index = create_faiss_index(embeddings)
+        print("{} index created with {} chunks".format(config.index_type, index.ntotal))
         self.index = index
         self.chunks = chunks
         self.set_chunk_indices()
 
+        if snapshot_path:
+            self.save_snapshot(snapshot_path)
+
+    def save_snapshot(self, snapshot_path: str):
+        """Writes index, retrieval strings and chunks to `snapshot_path`.
+
+        The snapshot is written to a temporary directory first and renamed into place, so a concurrently
+        starting process either sees the complete snapshot or none at all.
+        """
+        tmp_path = f"{snapshot_path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        faiss.write_index(self.index, os.path.join(tmp_path, SNAPSHOT_INDEX_FILE))
+        with open(os.path.join(tmp_path, SNAPSHOT_CHUNKS_FILE), "w") as file:
+            json.dump(
+                [(text, chunk.to_dict()) for text, chunk in zip(self.retrieval_strings, self.chunks)],
+                file,
+                ensure_ascii=False,
+            )
+        with open(os.path.join(tmp_path, SNAPSHOT_META_FILE), "w") as file:
+            json.dump(
+                {
+                    "snapshot_version": SNAPSHOT_VERSION,
+                    "chunks_hash": self.version,
+                    "embedding_model": EMBEDDING_MODEL,
+                    "index_spec": get_index_spec(),
+                    "ntotal": self.index.ntotal,
+                    "dimension": self.index.d,
+                    "created_at": int(time.time()),
+                },
+                file,
+                indent=4,
+            )
+
+        try:
+            os.rename(tmp_path, snapshot_path)
+            print(f"Index snapshot saved to {snapshot_path}")
+        except OSError:
+            # Another process wrote the same snapshot first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.snapshot_path = snapshot_path
+
+    def load_snapshot(self, snapshot_path: str):
+        """Loads a snapshot written by `save_snapshot`. The index is memory-mapped, not read into memory.
+
+        The vectors are searched in place in the mapped file, so processes loading the same snapshot share its pages.
+        """
+        with open(os.path.join(snapshot_path, SNAPSHOT_META_FILE), "r") as file:
+            meta = json.load(file)
+        if meta["snapshot_version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {meta['snapshot_version']} in {snapshot_path}")
+
+        # IO_FLAG_MMAP still copies the codes of flat and HNSW indexes, IO_FLAG_MMAP_IFC maps them for every type
+        self.index = faiss.read_index(os.path.join(snapshot_path, SNAPSHOT_INDEX_FILE), faiss.IO_FLAG_MMAP_IFC)
+        set_search_params(self.index)
+        with open(os.path.join(snapshot_path, SNAPSHOT_CHUNKS_FILE), "r") as file:
+            chunks_raw = json.load(file)
+        self.retrieval_strings = [text for text, _ in chunks_raw]
+        self.chunks = [Chunk.from_dict(chunk_dict) for _, chunk_dict in chunks_raw]
+        self.version = meta["chunks_hash"]
+        self.snapshot_path = snapshot_path
+        self.set_chunk_indices()
+        print(f"Index snapshot {self.version} loaded with {self.index.ntotal} chunks from {snapshot_path}")
+
     def search_index(self, query_embedding, k: int) -> tuple[list[float], list[Chunk]]:
         D, I = self.index.search(query_embedding, k)
+        return self._expand_and_merge(I[0], D[0])
+
+    def search_batch(
+        self, queries: list[str], k: int, max_results: int | None = None
+    ) -> list[tuple[list[float], list[Chunk]]]:
+        """Embeds all queries in one call and searches them with a single index.search.
+
+        Args:
+            queries (list[str]): Queries, already abbreviation-expanded.
+            k (int): Number of nearest chunks per query before neighbour expansion and merging.
+            max_results (int | None, optional): Keep only the best merged chunks per query. Defaults to all.
+
+        Returns:
+            list[tuple[list[float], list[Chunk]]]: Scores and chunks per query, in the order of `queries`.
+        """
+        query_embeddings = embed_chunks(queries, task_type="search_query")
+        D, I = self.index.search(query_embeddings, k)
+        return [
+            self._expand_and_merge(indices, similarities, max_results) for indices, similarities in zip(I, D)
+        ]
 
-        retrieved_indices = {idx: sim for idx, sim in zip(I[0], D[0])}
+    def _expand_and_merge(
+        self, indices: np.ndarray, similarities: np.ndarray, max_results: int | None = None
+    ) -> tuple[list[float], list[Chunk]]:
+        indices = np.asarray(indices, dtype=np.int64)
+        similarities = np.asarray(similarities, dtype=np.float32)
+        found = indices >= 0  # FAISS pads with -1 if fewer than k results exist
+        indices, similarities = indices[found], similarities[found]
 
         if config.surrounding_chunk_length > 0:
-            print("Expanding retrieved indices with surrounding chunks")
-            original_indices = list(retrieved_indices.items())
-            print("Original indices: ", original_indices)
-            for idx, similarity_score in original_indices:
-                original_section = self.chunks[idx].section_heading
-                for offset in range(1, config.surrounding_chunk_length + 1):
-                    for new_idx in (idx - offset, idx + offset):
-                        if 0 <= new_idx < len(self.chunks) and self.chunks[new_idx].section_heading == original_section:
-                            # Add only if index doesn't exist or has a lower similarity score
-                            if new_idx not in retrieved_indices:
-                                retrieved_indices[new_idx] = 0
-                            elif retrieved_indices[new_idx] < similarity_score:
-                                retrieved_indices[new_idx] = similarity_score
-
-            print("Expanded indices: ", retrieved_indices)
-        expanded_indices = sorted(retrieved_indices.items())
-        expanded_indices.sort(key=lambda tup: tup[0])
-        sorted_retrieved_chunks = [(self.chunks[idx], sim) for idx, sim in expanded_indices]
-        # print("Sorted retrieved chunks as str: ", [(score, str(c)) for c, score in sorted_retrieved_chunks])
-        scores, returned_chunks = self.merge_chunks_if_consecutive(sorted_retrieved_chunks)
-        return scores, returned_chunks
+            positions, scores = self._expand_with_neighbours(indices, similarities, config.surrounding_chunk_length)
+            print("Expanded indices: ", dict(zip(positions.tolist(), scores.tolist())))
+        else:
+            order = np.argsort(indices, kind="stable")
+            positions, scores = indices[order], similarities[order]
+
+        return self._merge_consecutive(positions, scores, max_results)
+
+    def _expand_with_neighbours(
+        self, indices: np.ndarray, similarities: np.ndarray, length: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Adds up to `length` chunks on each side of every retrieved chunk, within the same section.
+
+        A retrieved chunk keeps the highest score among its own and those of the retrieved chunks it neighbours.
+        A chunk added only as a neighbour is inserted with score 0 by the best ranked retrieved chunk reaching it
+        and raised to the scores of further retrieved chunks reaching it.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Sorted chunk positions and their scores.
+        """
+        num_chunks = len(self.chunks)
+        offsets = np.concatenate([np.arange(-length, 0), np.arange(1, length + 1)])
+        neighbours = indices[:, None] + offsets[None, :]
+        in_bounds = (neighbours >= 0) & (neighbours < num_chunks)
+        same_section = in_bounds & (
+            self.section_ids[np.clip(neighbours, 0, num_chunks - 1)] == self.section_ids[indices][:, None]
+        )
+
+        neighbour_positions = neighbours[same_section]
+        neighbour_scores = np.broadcast_to(similarities[:, None], neighbours.shape)[same_section]
+        ranks = np.broadcast_to(np.arange(len(indices))[:, None], neighbours.shape)[same_section]
+
+        positions = np.union1d(indices, neighbour_positions)
+        scores = np.zeros(len(positions), dtype=np.float32)
+        scores[np.searchsorted(positions, indices)] = similarities
+        if len(neighbour_positions) == 0:
+            return positions, scores
+
+        # Group the neighbour hits by position, each group in rank order of the retrieved chunks
+        order = np.lexsort((ranks, neighbour_positions))
+        neighbour_positions, neighbour_scores = neighbour_positions[order], neighbour_scores[order]
+        reached, group_starts = np.unique(neighbour_positions, return_index=True)
+        best_reach = np.maximum.reduceat(neighbour_scores, group_starts)
+        later_scores = neighbour_scores.copy()
+        later_scores[group_starts] = 0
+        later_reach = np.maximum.reduceat(later_scores, group_starts)
+
+        is_retrieved = np.isin(reached, indices)
+        reached_slots = np.searchsorted(positions, reached)
+        scores[reached_slots] = np.where(
+            is_retrieved, np.maximum(scores[reached_slots], best_reach), later_reach
+        )
+        return positions, scores
+
+    def _merge_consecutive(
+        self, positions: np.ndarray, scores: np.ndarray, max_results: int | None = None
+    ) -> tuple[list[float], list[Chunk]]:
+        """Merges runs of consecutive text chunks of the same section and sorts the runs by their best score.
+
+        Chunk text is only joined for the runs that are returned.
+        """
+        if len(positions) == 0:
+            return [], []
+
+        # No merge for tables and flowcharts
+        continues_run = (
+            (np.diff(positions) == 1)
+            & (self.section_ids[positions[1:]] == self.section_ids[positions[:-1]])
+            & self.mergeable[positions[1:]]
+        )
+        run_starts = np.flatnonzero(np.concatenate([[True], ~continues_run]))
+        run_ends = np.append(run_starts[1:], len(positions))
+        run_scores = np.maximum.reduceat(scores, run_starts)
+
+        # Sort by similarity score
+        order = np.argsort(-run_scores, kind="stable")[:max_results]
+        merged_chunks = [self._merge_run(positions[run_starts[run] : run_ends[run]]) for run in order]
+        return run_scores[order].tolist(), merged_chunks
+
+    def _merge_run(self, run_positions: np.ndarray) -> Chunk:
+        merged_chunk = self.chunks[run_positions[0]].copy()
+        merged_chunk.index = None
+        if len(run_positions) > 1:
+            run_chunks = [self.chunks[position] for position in run_positions]
+            merged_chunk.text = " ".join(chunk.text for chunk in run_chunks)
+            merged_chunk.end_page = max(chunk.end_page for chunk in run_chunks)
+        return merged_chunk
 
     def set_chunk_indices(self):
         for i, chunk in enumerate(self.chunks):
             chunk.index = i
 
-    def merge_chunks_if_consecutive(self, sorted_chunks: list[tuple[Chunk, float]]) -> list[Chunk]:
-        merged_chunks = []
-
-        scores = [score for _, score in sorted_chunks]
-        sorted_chunks = [chunk for chunk, _ in sorted_chunks]
-        current_chunk = sorted_chunks[0].copy()
-        current_scores = [scores[0]]
-
-        for i in range(1, len(sorted_chunks)):
-            next_chunk = sorted_chunks[i].copy()
-            next_score = scores[i]
-
-            # No merge for tables and flowcharts
-            # If type is none, might be problematic
-            if (
-                next_chunk.type not in (ChunkType.TABLE, ChunkType.FLOWCHART)
-                and next_chunk.index == (current_chunk.index + 1)
-                and next_chunk.section_heading == current_chunk.section_heading
-            ):
-                current_chunk.text += " " + next_chunk.text
-                current_chunk.end_page = max(current_chunk.end_page, next_chunk.end_page)
-                current_chunk.index = next_chunk.index
-                current_scores.append(next_score)
-            else:
-                merged_chunks.append((current_chunk, max(current_scores)))
-                current_chunk = next_chunk
-                current_scores = [next_score]
-
-        merged_chunks.append((current_chunk, max(current_scores)))
+        # Per-chunk arrays used by the vectorized neighbour expansion and merging at search time
+        section_ids = {}
+        self.section_ids = np.array(
+            [section_ids.setdefault(chunk.section_heading, len(section_ids)) for chunk in self.chunks],
+            dtype=np.int32,
+        )
+        self.mergeable = np.array(
+            [chunk.type not in (ChunkType.TABLE, ChunkType.FLOWCHART) for chunk in self.chunks], dtype=bool
+        )
 
-        # Sort by similarity score
-        merged_chunks.sort(key=lambda x: x[1], reverse=True)
-        retrieved_chunks = [chunk for chunk, _ in merged_chunks]
-        scores = [score for _, score in merged_chunks]
 
-        for chunk in retrieved_chunks:
-            chunk.index = None
+def get_search_params(index: faiss.Index) -> tuple:
+    """Search-time parameters currently set on the index."""
+    if isinstance(index, faiss.IndexHNSW):
+        return ("efSearch", index.hnsw.efSearch)
+    elif isinstance(index, faiss.IndexIVF):
+        return ("nprobe", index.nprobe)
+    return ()
 
-        return scores, retrieved_chunks
 
+def _retrieve(query: str, faiss_service: FaissService, use_cache: bool = False) -> list[Chunk]:
+    """Retrieves the chunks for a query, use_cache serves repeated questions of the chatbot from the retrieval cache.
 
-def _retrieve(query: str, faiss_service: FaissService) -> list[Chunk]:
+    Evaluations keep use_cache off, since the near-duplicate tier can return the chunks of a similar question.
+    """
     print("Retrieving with query: ", query)
     query, _ = replace_abbreviations(query)
+
+    # The cache key describes a flat index search, HierarchicalFaissService results are not cached
+    cache = (
+        get_retrieval_cache()
+        if use_cache and isinstance(faiss_service, FaissService) and faiss_service.version is not None
+        else None
+    )
+    if cache is not None:
+        # Everything besides the query that changes the results, the version changes whenever the index is rebuilt
+        params = (
+            faiss_service.version,
+            config.index_type,
+            get_search_params(faiss_service.index),
+            config.top_k,
+            config.surrounding_chunk_length,
+        )
+    if cache is not None and (cached := cache.get(params, query)) is not None:
+        print("Retrieval cache hit")
+        return cached[1]
+
     query_embedding = embed_chunks(query, task_type="search_query")
+    if cache is not None and (cached := cache.get_similar(params, query_embedding)) is not None:
+        print("Retrieval cache hit for a similar query")
+        return cached[1]
 
     sims, retrieved_documents = faiss_service.search_index(query_embedding, config.top_k)
     print(sims)
+    if cache is not None:
+        cache.put(params, query, query_embedding, sims, retrieved_documents)
     return retrieved_documents
 
 
@@ -199,11 +472,8 @@ def _retrieve_and_rank(queries: list[str], faiss_service: FaissService) -> list[
     # Because of the length of the queries, does it make sense to compare scores?
     all_retrieved_documents = []
 
-    for query in queries:
-        query, _ = replace_abbreviations(query)
-        query_embedding = embed_chunks(query, task_type="search_query")
-
-        similarities, retrieved_documents = faiss_service.search_index(query_embedding, config.top_k)
+    queries = [query for query, _ in replace_abbreviations_batch(queries)]
+    for similarities, retrieved_documents in faiss_service.search_batch(queries, config.top_k, config.top_k):
         all_retrieved_documents.extend(zip(retrieved_documents, similarities))
 
     all_retrieved_documents.sort(key=lambda x: x[1], reverse=True)
@@ -222,7 +492,7 @@ def retrieve(
         query = question
     if production:
         if config.use_original_query_only:
-            return _retrieve(query, faiss_service)
+            return _retrieve(query, faiss_service, use_cache=True)
     else:
         if config.use_original_query_only:
             return _retrieve(query, faiss_service)
@@ -288,7 +558,7 @@ def describe_table_for_retrieval(table: Chunk, document: Document):
         
         The table content:\n{table.text}
         """  ## start and end page are the same for tables
-    response = generate_response(user_prompt, TABLES_RETRIEVAL_PROMPT)
+    response = generate_response(user_prompt, TABLES_RETRIEVAL_PROMPT, response_model=TableDescription)
     try:
         response = parse_with_retry(TableDescription, response)
         print("Response within summarization: ", response)
@@ -334,7 +604,6 @@ def gather_chunks_orderly(sorted_text_chunks: list[Chunk], sorted_table_chunks:
 def create_flowchart_chunks(flowchart_directory) -> list[Chunk]:
     # Configured for Qwen 2.5
     url = f"http://0.0.0.0:{config.vlm_port}/generate"
-    headers = {"Content-Type": "application/json"}
     flowchart_directory = os.path.join(settings.data_path, "flowcharts")
 
     flowchart_paths = []
@@ -342,22 +611,31 @@ def create_flowchart_chunks(flowchart_directory) -> list[Chunk]:
         if file_name.endswith(".png"):
             flowchart_paths.append(os.path.join(flowchart_directory, file_name))
 
-    fchunks = []
+    page_numbers = []
+    requests_data = []
     for flowchart_path in flowchart_paths:
         try:
             page_number = int(flowchart_path.split("/")[-1].split(".")[0].replace("page", ""))
         except Exception as e:
             raise ValueError(f"Could not parse page number from {flowchart_path}: {e}")
-        print(f"Processing page {page_number}")
         with open(flowchart_path, "rb") as img_file:
             img_base64 = base64.b64encode(img_file.read()).decode("utf-8")
 
+        page_numbers.append(page_number)
         data = {"prompt": FLOWCHART_DESCRIPTION_PROMPT, "max_new_tokens": 1024, "image_input": img_base64}
+        if json_schema := get_json_schema(FlowchartDescription):
+            data["json_schema"] = json_schema
+        requests_data.append(data)
+
+    # All flowcharts are sent at once so the VLM server can describe them in batches
+    print(f"Processing {len(requests_data)} flowchart pages")
+    response_texts = get_llm_client().post_many(url, requests_data)
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        print("Response:", response.text)
+    fchunks = []
+    for page_number, response_text in zip(page_numbers, response_texts):
+        print(f"Response for page {page_number}:", response_text)
         try:
-            parsed_response = parse_with_retry(FlowchartDescription, response.text)
+            parsed_response = parse_with_retry(FlowchartDescription, response_text)
             print("Response within summarization: ", parsed_response)
             fchunks.append(
                 Chunk(
@@ -408,6 +686,7 @@ class HierarchicalFaissService:
         # Store tuples of (retrieval_string, Chunk) grouped by section
         self.chunks_by_section = defaultdict(list[tuple[str, Chunk]])
         self.section_retrieval_strings = []  # List of strings used for layer 1 retrieval (section IDs/headings)
+        self.version: str | None = None
 
     def _get_section_id(self, chunk: Chunk) -> str:
         """Determines the section identifier for a chunk."""
@@ -503,6 +782,12 @@ class HierarchicalFaissService:
 
         print(f"Layer 2 indices created for {len(self.layer2_indices)} sections.")
 
+        # The section summaries are hardcoded above, so they are part of what the index was built from
+        chunks_hash = compute_chunks_hash([rs for rs, _ in chunks], [chunk for _, chunk in chunks])
+        self.version = hashlib.sha256(
+            json.dumps([chunks_hash, self.section_retrieval_strings], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:16]
+
     def search_index(
         self, query_embedding: np.ndarray, k: int = 5, k1_sections: int = 2
     ) -> tuple[list[float], list[Chunk]]:
@@ -571,3 +856,23 @@ class HierarchicalFaissService:
         final_chunks = [chunk for score, chunk in top_k_results]
 
         return final_scores, final_chunks
+
+    def search_batch(
+        self, queries: list[str], k: int, max_results: int | None = None
+    ) -> list[tuple[list[float], list[Chunk]]]:
+        """Embeds all queries in one call and searches the hierarchy once per query, like FaissService.search_batch.
+
+        Args:
+            queries (list[str]): Queries, already abbreviation-expanded.
+            k (int): Number of chunks per query.
+            max_results (int | None, optional): Keep only the best chunks per query. Defaults to all.
+
+        Returns:
+            list[tuple[list[float], list[Chunk]]]: Scores and chunks per query, in the order of `queries`.
+        """
+        query_embeddings = embed_chunks(queries, task_type="search_query")
+        results = []
+        for query_embedding in query_embeddings:
+            scores, chunks = self.search_index(query_embedding, k)
+            results.append((scores[:max_results], chunks[:max_results]))
+        return results
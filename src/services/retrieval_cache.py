@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+import numpy as np
+
+from domain.document import Chunk
+from settings.settings import config
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace differences do not change what a clinician is asking for."""
+    return " ".join(query.split()).casefold()
+
+
+class RetrievalCache:
+    """
+    In-memory LRU+TTL cache of retrieval results for repeated questions.
+
+    Entries are keyed by the search parameters, which include the index version, and the normalized query. An exact
+    hit skips embedding and search. Otherwise the query embedding is compared with the cached queries of the same
+    search parameters, and a paraphrase with cosine similarity of at least similarity_threshold reuses their results.
+    Entries of a rebuilt index are never matched again and age out through the LRU.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float | None = None, similarity_threshold: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        # key -> (normalized query embedding, scores, chunks, created)
+        self._entries: OrderedDict[tuple, tuple[np.ndarray, list[float], list[Chunk], float]] = OrderedDict()
+        # Cached query embeddings per search parameters for the near-duplicate lookup, rebuilt lazily after changes
+        self._matrices: dict[Hashable, tuple[list[tuple], np.ndarray]] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def get(self, params: Hashable, query: str) -> tuple[list[float], list[Chunk]] | None:
+        """Returns the cached scores and chunks of an identical query, or None."""
+        key = (params, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], list(entry[2])
+
+    def get_similar(self, params: Hashable, query_embedding: np.ndarray) -> tuple[list[float], list[Chunk]] | None:
+        """Returns the cached results of the most similar query above the threshold, or None."""
+        if self.similarity_threshold is None:
+            return None
+        vector = self._normalize(query_embedding)
+        with self._lock:
+            if params not in self._matrices:
+                keys = [key for key in self._entries if key[0] == params]
+                if not keys:
+                    return None
+                self._matrices[params] = (keys, np.stack([self._entries[key][0] for key in keys]))
+            keys, matrix = self._matrices[params]
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            entry = self._entries[keys[best]]
+            if similarities[best] < self.similarity_threshold or self._expired(entry):
+                return None
+            self._entries.move_to_end(keys[best])
+            self.near_hits += 1
+            return entry[1], list(entry[2])
+
+    def put(self, params: Hashable, query: str, query_embedding: np.ndarray, scores: list[float], chunks: list[Chunk]):
+        key = (params, normalize_query(query))
+        with self._lock:
+            self._entries[key] = (self._normalize(query_embedding), list(scores), list(chunks), time.time())
+            self._entries.move_to_end(key)
+            self.misses += 1
+            self._matrices.pop(params, None)
+            self._evict()
+
+    def _expired(self, entry: tuple) -> bool:
+        return self.ttl is not None and time.time() - entry[3] > self.ttl
+
+    def _evict(self):
+        if self.ttl is not None:
+            for key in [key for key, entry in self._entries.items() if self._expired(entry)]:
+                del self._entries[key]
+                self._matrices.pop(key[0], None)
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._matrices.pop(key[0], None)
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+_retrieval_cache: RetrievalCache | None = None
+
+
+def get_retrieval_cache() -> RetrievalCache | None:
+    """Returns the process-wide retrieval cache, or None if config.retrieval_cache_max_entries is 0."""
+    global _retrieval_cache
+    if _retrieval_cache is None and config.retrieval_cache_max_entries > 0:
+        _retrieval_cache = RetrievalCache(
+            config.retrieval_cache_max_entries, config.retrieval_cache_ttl, config.retrieval_cache_similarity
+        )
+    return _retrieval_cache
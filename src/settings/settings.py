@@ -62,18 +62,55 @@ class Config(BaseModel):
     chunk_size: int = 512
     surrounding_chunk_length: int = 0
 
+    index_type: Literal["flat", "hnsw", "ivf_flat", "ivf_pq"] = "flat"
+    hnsw_m: int = 32
+    hnsw_ef_construction: int = 40
+    hnsw_ef_search: int = 64
+    ivf_nlist: int = 64
+    ivf_nprobe: int = 8
+    pq_m: int = 16  # must divide the embedding dimension
+    pq_nbits: int = 8
+
     reasoning: bool = False
     thinking: bool = False
+    constrained_decoding: bool = False  # model servers enforce the JSON schema of the expected response
 
     saved_chunks_path_raw: str | None = None
+    index_snapshot_dir_raw: str | None = None  # relative to results_path, disables snapshots if unset
+    embedding_cache_path_raw: str | None = None  # relative to results_path, disables the cache if unset
+    embedding_cache_max_entries: int = 200_000
+    retrieval_cache_max_entries: int = 1024  # 0 disables the retrieval result cache
+    retrieval_cache_ttl: float | None = 3600  # seconds, None keeps results until they are evicted
+    retrieval_cache_similarity: float | None = None  # queries at least this similar share results, None disables
+    detect_boilerplate: bool = False  # also strip header and footer lines that repeat across pages
+    preprocess_cpu_workers: int = 1  # processes for the regex stages of process_document, 1 runs them inline
+    preprocess_llm_workers: int = 8  # pages sent to whitespace injection concurrently
+    page_cache_path_raw: str | None = None  # relative to results_path, disables the page cache if unset
 
     ragas: bool = False
+    eval_max_workers: int = 8  # questions evaluated concurrently
+    eval_question_timeout: float | None = None  # seconds per question, None waits indefinitely
+    evaluation_journal_dir_raw: str | None = None  # relative to results_path, disables resuming if unset
+
+    conversation_store: Literal["memory", "sqlite"] = "memory"  # sqlite is needed for several server workers
+    conversation_store_path_raw: str | None = None  # relative to results_path, used by the sqlite store
+    conversation_ttl: float | None = 86_400  # seconds since the last update, None keeps conversations
+    conversation_max_entries: int = 10_000
 
     following_flowchart: bool = False
     flowchart_page: int | None = None
 
     llm_port: int = 8084
     vlm_port: int = 8082
+    llm_timeout: float | None = None  # read timeout in seconds, None waits for the generation to finish
+    llm_connect_timeout: float = 10.0
+    llm_max_connections: int = 32
+    llm_max_retries: int = 2
+    llm_retry_backoff: float = 1.0
+    llm_cache_path_raw: str | None = None  # relative to results_path, disables the response cache if unset
+    llm_cache_ttl: float | None = 604_800  # seconds, None keeps responses until they are evicted
+    llm_cache_max_entries: int = 100_000
+    llm_cache_namespace: str = ""  # change when the served model changes without a config change
 
     def dump(self, file_path: str) -> None:
         with open(file_path, "w", encoding="utf-8") as file:
@@ -86,6 +123,48 @@ class Config(BaseModel):
         else:
             None
 
+    @property
+    def index_snapshot_dir(self):
+        if self.index_snapshot_dir_raw:
+            return os.path.join(settings.results_path, self.index_snapshot_dir_raw)
+        else:
+            return None
+
+    @property
+    def evaluation_journal_dir(self):
+        if self.evaluation_journal_dir_raw:
+            return os.path.join(settings.results_path, self.evaluation_journal_dir_raw)
+        else:
+            return None
+
+    @property
+    def page_cache_path(self):
+        if self.page_cache_path_raw:
+            return os.path.join(settings.results_path, self.page_cache_path_raw)
+        else:
+            return None
+
+    @property
+    def llm_cache_path(self):
+        if self.llm_cache_path_raw:
+            return os.path.join(settings.results_path, self.llm_cache_path_raw)
+        else:
+            return None
+
+    @property
+    def conversation_store_path(self):
+        if self.conversation_store_path_raw:
+            return os.path.join(settings.results_path, self.conversation_store_path_raw)
+        else:
+            return None
+
+    @property
+    def embedding_cache_path(self):
+        if self.embedding_cache_path_raw:
+            return os.path.join(settings.results_path, self.embedding_cache_path_raw)
+        else:
+            return None
+
 
 with open(settings.config_path, "r", encoding="utf-8") as file:
     raw_config = yaml.safe_load(file)